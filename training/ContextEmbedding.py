@@ -11,9 +11,10 @@ from transformers import BertTokenizer, BertModel
 import logging
 import pandas as pd
 import numpy as np
-from tqdm  import  tqdm
+from training.embeddingPipeline import BertEmbedder
 logging.basicConfig(level=logging.INFO)
 
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
 #load pre-trained model tokenizer (vocabulary)
 tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
 
@@ -31,10 +32,10 @@ model.eval()     #switch to eval mode (remove things like dropout)
 #Convert input to pytorch tensors
 tokens_tensor = torch.tensor([indexed_tokens])
 segments_tensors = torch.tensor([segments_ids])
-#Put everything on the gpu:
-tokens_tensor = tokens_tensor.to('cuda')
-segments_tensors = segments_tensors.to('cuda')
-model.to('cuda')
+#Put everything on the gpu (if any):
+tokens_tensor = tokens_tensor.to(device)
+segments_tensors = segments_tensors.to(device)
+model.to(device)
 
 with torch.no_grad():
     outputs = model(tokens_tensor, token_type_ids = segments_tensors)
@@ -53,42 +54,20 @@ link_text = pd.read_csv("links_with_context.csv",usecols=[0])
 link_text_data = link_text.values
 link_text_data = link_text_data.reshape(link_text_data.shape[0])
 link_text_data_nostringmark = [c.replace("\"","") for c in link_text_data]
-link_text_data_nostringmark_tokeninit = ["[CLS] "+c+" [SEP]" for c in link_text_data_nostringmark] #add separator used in BERT
-link_text_token=[]
-for c in tqdm(link_text_data_nostringmark_tokeninit):# this step takes about 1 minutes of time.... tqdm is for progression bar
-    link_text_token += [tokenizer.tokenize(c)]
-link_text_tokenID =  [tokenizer.convert_tokens_to_ids(c) for c in link_text_token]
-
-# Let us embed everything:
-# First we must pad the inputs so that we have a tensor (then we can use batched operation)
-# Note: Bert max input sequence is 512 we can get it through:
-max_model_input_size = tokenizer.max_model_input_sizes['bert-base-uncased']
-pad_dim = 0
-for c in link_text_tokenID:
-    if (len(c)>pad_dim):
-        pad_dim = len(c)
-assert pad_dim<max_model_input_size
-link_text_tokenID_padded = [c+[0 for _ in range(pad_dim-len(c))] for c in link_text_tokenID]
-print("pad_dim for link_text is ",pad_dim)
-
-link_text_tensor = torch.tensor(link_text_tokenID_padded)
-#Typically here we run out of memory on cuda if trying to do everything in a single batch, so need to separate in mini-batch
-link_text_outputs = np.empty((0,768))
-mini_batch_size = 200
-for j in tqdm(range(0,link_text_tensor.shape[0],mini_batch_size)): # takes about 40 minutes to run...
-    link_text_tensor_mb = link_text_tensor[j:min(j+mini_batch_size,link_text_tensor.shape[0])].to('cuda')
-    with torch.no_grad():
-        link_text_minibatch_outputs = torch.mean(model(link_text_tensor_mb)[0],dim=1).cpu()
-        link_text_outputs = np.concatenate([link_text_outputs,link_text_minibatch_outputs])
+# Let us embed everything with the shared embedder (see embeddingPipeline.py):
+# batched fast tokenization (adds [CLS] and [SEP], truncates to 512), length-bucketed batches,
+# and a mean over the real tokens only thanks to the attention mask.
+embedder = BertEmbedder("bert-base-uncased",device=device)
+link_text_outputs = embedder.encode(link_text_data_nostringmark)
 # save into a csv
 save_link_text_outputs = pd.DataFrame(link_text_outputs)
 save_link_text_outputs.to_csv("link_text_embeding.csv")
 
-from sklearn.decomposition import PCA
+from training.blockPca import BlockPCA
 from sklearn.manifold import TSNE
 
-PCA_tool = PCA(n_components=50) # we will keep the 50 best component and then execute a t-sne on this
-PCA_reduced = PCA_tool.fit(link_text_outputs)
+PCA_tool = BlockPCA(n_components=50) # we will keep the 50 best component and then execute a t-sne on this
+PCA_reduced = PCA_tool.fit_transform(link_text_outputs)
 save_PCA_reduced = pd.DataFrame(PCA_reduced)
 save_PCA_reduced.to_csv("text_link_PCA_reduced.csv")
 TSNE_tool = TSNE()
@@ -136,44 +115,9 @@ context_data_nostringmark = [ c.replace("\"\"\"","") for c in context_data]
 nbrLNK = ["<<LNK>>" in c1 for c1 in context_data_nostringmark]
 print("There is <<LNK>> in ",sum(nbrLNK),"out of",len(context_data_nostringmark))
 context_data_addedLNK = [c.replace("<<LNK>>",c2) for c,c2 in zip(context_data_nostringmark,link_text_data_nostringmark)]
-context_token=[]
-for c in tqdm(context_data_addedLNK):# this step takes about 1 minutes of time.... tqdm is for progression bar
-    context_token += [tokenizer.tokenize(c)]
-context_tokenID =  [tokenizer.convert_tokens_to_ids(c) for c in context_token]
-
-# Let us embed everything:
-# First we must pad the inputs so that we have a tensor (then we can use batched operation)
-# Note: Bert max input sequence is 512 we can get it through:
-max_model_input_size = tokenizer.max_model_input_sizes['bert-base-uncased']
-pad_dim = 0
-for c in context_tokenID:
-    if (len(c)>pad_dim):
-        pad_dim = len(c)
-assert pad_dim<max_model_input_size
-context_tokenID_padded = [c+[0 for _ in range(pad_dim-len(c))] for c in context_tokenID]
-print("pad_dim for link_text is ",pad_dim)
-
-context_tensor = torch.tensor(context_tokenID_padded)
-#Typically here we run out of memory on cuda if trying to do everything in a single batch, so need to separate in mini-batch
-context_outputs = np.empty((0,768))
-mini_batch_size = 10
-for j in tqdm(range(0,context_tensor.shape[0],mini_batch_size)): # takes about 40 minutes to run...
-    context_tensor_mb = context_tensor[j:min(j+mini_batch_size,context_tensor.shape[0])].to('cuda')
-    with torch.no_grad():
-        context_minibatch_outputs = torch.mean(model(context_tensor_mb)[0],dim=1).cpu()
-        context_outputs = np.concatenate([context_outputs,context_minibatch_outputs])
-# save into a csv
-context_tensor = torch.tensor(context_tokenID_padded)
-#Typically here we run out of memory on cuda if trying to do everything in a single batch, so need to separate in mini-batch
-context_outputs = np.empty((0,768))
-mini_batch_size = 10
-for j in tqdm(range(0,context_tensor.shape[0],mini_batch_size)): # takes about 40 minutes to run...
-    context_tensor_mb = context_tensor[j:min(j+mini_batch_size,context_tensor.shape[0])].to('cuda')
-    with torch.no_grad():
-        context_minibatch_outputs = torch.mean(model(context_tensor_mb)[0],dim=1).cpu()
-        context_outputs = np.concatenate([context_outputs,context_minibatch_outputs])
-
-PCA_tool_context = PCA(n_components=50) # we will keep the 50 best component and then execute a t-sne on this
+context_outputs = embedder.encode(context_data_addedLNK)
+
+PCA_tool_context = BlockPCA(n_components=50) # we will keep the 50 best component and then execute a t-sne on this
 PCA_reduced_context = PCA_tool_context.fit_transform(context_outputs)
 save_PCA_reduced_context = pd.DataFrame(PCA_reduced_context)
 save_PCA_reduced_context.to_csv("context_PCA_reduced.csv")
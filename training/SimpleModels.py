@@ -4,18 +4,43 @@ Created by Pierre Orhan 25/11/2019
 Some simple regression models acting as baselines.
 """
 
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
-from sklearn.cross_decomposition import CCA
+from training.tsneTransform import TsneTransform
+import numpy as np
+from training.blockPca import BlockPCA
+from training.exactKnn import squaredDistances
+from training.streamingCca import StreamingCCA
 from sklearn.model_selection import GridSearchCV,RandomizedSearchCV
 import scipy.stats as spst
+import os
+import hashlib
+from joblib import dump,load
 
 
 import matplotlib.pyplot as plt
+def fingerprint(*arrays):
+    """sha1 of the shape, dtype and content of arrays."""
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update((str(a.shape)+a.dtype.str).encode())
+        h.update(memoryview(a).cast("B"))
+    return h.hexdigest()
+
+def cvSelect(n,candidates,foldScores,folds=3):
+    """
+    The candidate with the best mean score over contiguous folds of the n rows (the first one on ties, like
+    GridSearchCV). foldScores(train,test) returns the test score of every candidate, from one fit on the train rows.
+    """
+    scores = np.zeros(len(candidates))
+    for test in np.array_split(np.arange(n),folds):
+        scores += foldScores(np.setdiff1d(np.arange(n),test),test)
+    return candidates[int(np.argmax(scores))]
+
 # A model that concatenate multiple other model:
 class chain():
-    def __init__(self,models,args):
+    def __init__(self,models,args,cacheDir=os.path.join("data3","cache","stages")):
         self.models = []
+        self.stageKeys = []
         for m,arg in zip(models,args):
             if type(arg)==list:
                 self.models +=[m(*arg)]
@@ -23,15 +48,45 @@ class chain():
                 self.models +=[m(arg)]
             else:
                 self.models +=[m()]
+            self.stageKeys +=[m.__name__+"/v"+str(getattr(m,"version",0))+repr(arg)]
+        #Every stage is memoized in cacheDir (None: no cache): its fitted model and its outputs are keyed by the
+        #stage class, version and parameters and the key of its input, i.e. the fingerprint of the input arrays and
+        #the stages before. Chains with a common prefix (same first stages on the same data) only fit the stages
+        #that differ. Bump the version of a model class when its fitted attributes or outputs change, so that its
+        #pickles from older code are not loaded. Nothing is ever evicted: delete cacheDir to reclaim the space.
+        self.cacheDir = cacheDir
+        self.fitKeys = None
+    def stage(self,key,compute):
+        """compute() -> (model,a,b), memoized under key; the (possibly loaded) model and outputs are returned."""
+        if self.cacheDir is None:
+            return compute()
+        path = os.path.join(self.cacheDir,key+".joblib")
+        if os.path.exists(path):
+            return load(path)
+        os.makedirs(self.cacheDir,exist_ok=True)
+        result = compute()
+        tmp = path+".tmp"+str(os.getpid())
+        dump(result,tmp)
+        os.replace(tmp,path)
+        return result
     def fit(self,query,target):
         a,b = query,target
-        for m in self.models:
-            a,b = m.fit(a,b)
+        key = fingerprint(a,b)
+        self.fitKeys = []
+        for idx,(m,stageKey) in enumerate(zip(self.models,self.stageKeys)):
+            key = hashlib.sha1((key+"/fit/"+stageKey).encode()).hexdigest()
+            self.models[idx],a,b = self.stage(key,lambda: (m,)+tuple(m.fit(a,b)))
+            self.fitKeys +=[key]
         return a,b
     def predict(self,query,target):
         a,b = query,target
-        for m in self.models:
-            a,b = m.predict(a,b)
+        key = fingerprint(a,b)
+        for idx,m in enumerate(self.models):
+            if self.fitKeys is None: #not fitted by this chain: no key for the fitted models
+                a,b = m.predict(a,b)
+                continue
+            key = hashlib.sha1((key+"/predict/"+self.fitKeys[idx]).encode()).hexdigest()
+            _,a,b = self.stage(key,lambda: (None,)+tuple(m.predict(a,b)))
         return a,b
     def __str__(self):
         model_str = [str(m) for m in self.models]
@@ -46,72 +101,83 @@ class chain():
 
 #raw dimension reductions model
 class tsneModel():
+    version = 1
     def __init__(self,num_dimensions):
-        self.tsne = TSNE(n_components=num_dimensions, random_state=0)
+        self.tsne = TsneTransform(n_components=num_dimensions, random_state=0)
     def fit(self,query,target):
-        target_vectors = self.tsne.fit_transform(target)
-        query_vectors = self.tsne.fit_transform(query)
-        return query_vectors,target_vectors
+        #One t-SNE of the queries and targets together, so that both are embedded in the same space
+        vectors = self.tsne.fit_transform(np.concatenate([query,target]))
+        return vectors[:query.shape[0]],vectors[query.shape[0]:]
     def predict(self,query,target):
-        return self.fit(query,target) #The problem with TSNE is that it doesn't provide a predict function....
+        #New points are placed against the fitted embedding, without refitting (see tsneTransform.py)
+        vectors = self.tsne.transform(np.concatenate([query,target]))
+        return vectors[:query.shape[0]],vectors[query.shape[0]:]
     def __str__(self):
         return "tsne("+str(self.tsne.n_components)+")"
     def getmodel(self):
         return self.tsne
 class ccaModel():
+    version = 2
     def __init__(self,num_dimensions):
-        self.cca = CCA(n_components=num_dimensions) #But n_components will be changed by the  search
-        param_distributions = {
-            "n_components":np.arange(2,100,20),
-            "scale":[False,True],
-            "max_iter":[500,1000],
-            "tol": [1e-06,1e-05,1e-07]
-        }
-        self.randomSearch = GridSearchCV(self.cca,param_grid=param_distributions,
-                                          cv=3,n_jobs=3)
+        #Closed form: one fit gives the nested components of every n_components (see streamingCca.py)
+        self.num_dimensions = num_dimensions
+        self.cca = StreamingCCA(n_components=num_dimensions)
+        self.ranks = np.arange(2,100,20) #scale, max_iter and tol of the former grid do not apply to the closed form
     def fit(self,query,target):
-        self.randomSearch.fit(query,target)
+        #Same selection as the former GridSearchCV: 3-fold R^2 of the prediction of target, one fit per fold
+        ranks = [k for k in self.ranks if k<=min(query.shape[1],target.shape[1])] or [min(query.shape[1],target.shape[1])]
+        def foldScores(train,test):
+            return StreamingCCA().fit(query[train],target[train]).score(query[test],target[test],ranks)
+        self.cca.n_components = cvSelect(query.shape[0],ranks,foldScores)
+        self.cca.fit(query,target)
         query_vectors,target_vectors = self.predict(query,target)
         return query_vectors,target_vectors
     def predict(self,query,target):
-        query_vectors = self.randomSearch.transform(query)
-        target_vectors = self.randomSearch.transform(target)
+        query_vectors,target_vectors = self.cca.transform(query,target)
         return query_vectors,target_vectors
     def __str__(self):
-        return "cca("+str(self.cca.n_components)+")"
+        return "cca("+str(self.num_dimensions)+")"
     def getmodel(self):
-        return self.randomSearch
+        return self.cca
 class pcaModel():
+    version = 2
     def __init__(self,num_dimensions):
-        self.pca = PCA(n_components=num_dimensions)
-        param_distributions = {
-            "n_components":np.arange(2,100,20),
-            "whiten":[False,True],
-        }
-        self.randomSearch = GridSearchCV(self.pca,param_grid=param_distributions,
-                                               cv=3,n_jobs=-1)
+        #One decomposition over blocks of rows; every rank and whitening are then slices of it (see blockPca.py)
+        self.num_dimensions = num_dimensions
+        self.pca = BlockPCA(n_components=num_dimensions)
+        self.grid = [(k,whiten) for k in np.arange(2,100,20) for whiten in [False,True]]
     def fit(self,query,target):
-        self.randomSearch.fit(query)
-        query_vectors = self.randomSearch.transform(query)
-        target_vectors = self.randomSearch.transform(target)
+        #Same selection as the former GridSearchCV: 3-fold likelihood of the queries, one decomposition per fold.
+        #Whitening does not change the likelihood: the ties keep the first candidate, i.e. whiten=False.
+        grid = [(k,whiten) for k,whiten in self.grid if k<query.shape[1]] or [(query.shape[1],False)]
+        ranks = [k for k,_ in grid]
+        def foldScores(train,test):
+            return BlockPCA().fit(query[train]).score(query[test],ranks)
+        self.pca.n_components,self.pca.whiten = cvSelect(query.shape[0],grid,foldScores)
+        self.pca.fit(query)
+        query_vectors = self.pca.transform(query)
+        target_vectors = self.pca.transform(target)
         return query_vectors,target_vectors
     def predict(self,query,target):
-        query_vectors = self.randomSearch.transform(query)
-        target_vectors = self.randomSearch.transform(target)
+        query_vectors = self.pca.transform(query)
+        target_vectors = self.pca.transform(target)
         return query_vectors,target_vectors
     def __str__(self):
-        return "pca("+str(self.pca.n_components)+")"
+        return "pca("+str(self.num_dimensions)+")"
     def getmodel(self):
-        return self.randomSearch
+        return self.pca
 
 import torch
 from torch import nn
-import numpy as np
 #Now we build a NN model regressor that regress from one embedding space to the other one
 #TODO implement D-E for the training of the NN. Especially for the size of the layers.
 
 class nnRegression():
-    def __init__(self, num_dimensions, nb_batches, lr=0.01, momentum=0.9, nbEpoch = 100):
+    version = 1
+    def __init__(self, num_dimensions, nb_batches, lr=0.01, momentum=0.9, nbEpoch = 100, device=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
         self.model = nn.Sequential(
             nn.Linear(num_dimensions,100,bias=True),
             nn.Tanh(),
@@ -121,7 +187,7 @@ class nnRegression():
             nn.Tanh(),
             nn.Linear(100,num_dimensions)
         )
-        self.model.to("cuda")
+        self.model.to(self.device)
         self.model = self.model.float()
         self.num_dimensions = num_dimensions
         self.nb_batches = nb_batches
@@ -132,8 +198,8 @@ class nnRegression():
     def fit(self,query,target):
         X_c_train_batch = np.stack(np.split(query,self.nb_batches ,axis=0))
         Y_c_train_batch = np.stack(np.split(target,self.nb_batches ,axis=0))
-        X_c_train_batch_tensor = torch.tensor(X_c_train_batch,dtype=torch.float32).to("cuda")
-        Y_c_train_batch_tensor = torch.tensor(Y_c_train_batch,dtype=torch.float32).to("cuda")
+        X_c_train_batch_tensor = torch.tensor(X_c_train_batch,dtype=torch.float32).to(self.device)
+        Y_c_train_batch_tensor = torch.tensor(Y_c_train_batch,dtype=torch.float32).to(self.device)
 
         loss_fn = torch.nn.MSELoss()
         optimizer = torch.optim.SGD(self.model.parameters(), lr=self.lr , momentum=self.momentum)
@@ -157,7 +223,7 @@ class nnRegression():
         return self.predict(query,target) #the target is not modified here...
     def predict(self,query,target):
         with torch.no_grad():
-            X = torch.tensor(query,dtype=torch.float32).to("cuda")
+            X = torch.tensor(query,dtype=torch.float32).to(self.device)
             output_test = self.model(X).cpu()
         return output_test.numpy(),target
     def __str__(self):
@@ -166,6 +232,7 @@ class nnRegression():
 from sklearn.neural_network import  MLPRegressor
 from scipy.stats import  randint
 class MLPRegression():
+    version = 1
     def __init__(self,size):
         self.mlp = MLPRegressor(batch_size=20) #Don't search over batch size or tolerance.
         param_distributions = {
@@ -195,6 +262,7 @@ class MLPRegression():
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import RBF,ConstantKernel,Matern,RationalQuadratic
 class gpRegression():
+    version = 1
     def __init__(self):
         self.gpRegressor = GaussianProcessRegressor(RBF(),random_state=0) #todo: hyperparameter tuning over the kernel
         param_grid = {
@@ -209,4 +277,60 @@ class gpRegression():
     def __str__(self):
         return "GPR"
     def getmodel(self):
-        return self.gridsearch
\ No newline at end of file
+        return self.gridsearch
+#Approximate GP: the RBF kernel exp(-|x-x'|^2/(2*l^2)) is the expectation of phi(x).phi(x') for the random Fourier
+#features phi(x) = sqrt(2/D)*cos(xW+b), W~N(0,1/l^2), b~U(0,2pi). The GP mean is then a ridge regression on phi,
+#solved from the DxD matrix phi^T.phi accumulated over blocks of rows: O(n.D^2) time, O(D^2) memory, every output at once.
+#The length scale (multiples of the median distance) and the ridge penalty are selected by generalized
+#cross-validation, computed for every penalty from one eigendecomposition of phi^T.phi, without refitting.
+class rffRegression():
+    version = 1
+    def __init__(self,nFeatures=1024,scales=(0.5,1,2),alphas=np.logspace(-6,1,8),blockSize=8192,seed=0):
+        self.nFeatures = nFeatures
+        self.scales = scales
+        self.alphas = alphas
+        self.blockSize = blockSize
+        self.seed = seed
+    def features(self,X,W,b):
+        return np.sqrt(2/W.shape[1])*np.cos(np.asarray(X,dtype=np.float64)@W+b)
+    def fit(self,query,target):
+        rng = np.random.default_rng(self.seed)
+        n = query.shape[0]
+        target = np.asarray(target,dtype=np.float64).reshape(n,-1)
+        self.yMean = np.mean(target,axis=0)
+        Y = target-self.yMean
+        sample = np.asarray(query[rng.choice(n,min(n,1000),replace=False)],dtype=np.float64)
+        d = np.sqrt(squaredDistances(sample,sample)) #norms and one matmul: no (1000,1000,dim) difference array
+        median = np.median(d[d>0]) if np.any(d>0) else 1.0
+        normal = rng.standard_normal((query.shape[1],self.nFeatures))
+        b = rng.uniform(0,2*np.pi,self.nFeatures)
+        best = None
+        for scale in self.scales:
+            W = normal/(scale*median)
+            PhiTPhi = np.zeros((self.nFeatures,self.nFeatures))
+            PhiTY = np.zeros((self.nFeatures,Y.shape[1]))
+            for start in range(0,n,self.blockSize):
+                Phi = self.features(query[start:start+self.blockSize],W,b)
+                PhiTPhi += Phi.T@Phi
+                PhiTY += Phi.T@Y[start:start+self.blockSize]
+            s,V = np.linalg.eigh(PhiTPhi)
+            s = np.maximum(s,0)
+            c2 = np.sum(np.square(V.T@PhiTY),axis=1)
+            for alpha in self.alphas:
+                alpha = alpha*n #penalty relative to the number of rows
+                rss = np.sum(np.square(Y))-2*np.sum(c2/(s+alpha))+np.sum(s*c2/np.square(s+alpha))
+                dof = np.sum(s/(s+alpha))
+                gcv = n*max(rss,0)/np.square(max(n-dof,1))
+                if best is None or gcv<best[0]:
+                    best = (gcv,scale*median,alpha,W,(V/(s+alpha))@(V.T@PhiTY))
+        _,self.lengthScale,self.alpha,self.W,self.beta = best
+        self.b = b
+        return self.predict(query,target)
+    def predict(self,query,target):
+        out = np.concatenate([self.features(query[start:start+self.blockSize],self.W,self.b)@self.beta
+                              for start in range(0,query.shape[0],self.blockSize)])
+        return out+self.yMean,target
+    def __str__(self):
+        return "RFF-GPR("+str(self.nFeatures)+")"
+    def getmodel(self):
+        return self
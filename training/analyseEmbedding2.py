@@ -1,21 +1,20 @@
 import torch
 from transformers import BertTokenizer, BertModel
 import logging
-import pandas as pd
 import numpy as np
 import os
-from tqdm  import  tqdm
 import matplotlib.pyplot as plt
+from training import dataCache
 
 restrictSize = 1000
-data = pd.read_csv(os.path.join("data3","exact_hits.csv"),sep="\t",nrows=restrictSize)
+data = dataCache.readHits(nrows=restrictSize)
 target_link_data = data.values[:,3]
-embeddings = [pd.read_csv(os.path.join("data3","link_text.csv")).values[:,1:],
-              pd.read_csv(os.path.join("data3","link_context.csv")).values[:,1:],
-              pd.read_csv(os.path.join("data3","target_context.csv")).values[:,1:]]
+embeddings = [dataCache.readEmbedding(os.path.join("data3","link_text.emb")),
+              dataCache.readEmbedding(os.path.join("data3","link_context.emb")),
+              dataCache.readEmbedding(os.path.join("data3","target_context.emb"))]
 
 from sklearn.decomposition import PCA
-from sklearn.cross_decomposition import CCA
+from training.streamingCca import StreamingCCA
 from sklearn.manifold import TSNE
 
 pca = PCA(n_components=2)
@@ -37,7 +36,7 @@ plt.legend()
 plt.show()
 
 
-cca = CCA(n_components=2)
+cca = StreamingCCA(n_components=2) #closed form, accumulated over blocks of the memory-mapped embeddings
 cca.fit(embeddings[1],embeddings[2])
 X_c,Y_c = cca.transform(embeddings[1],embeddings[2])
 
@@ -61,17 +60,17 @@ plt.xticks(range(0,len(hist)), target_names_unique, rotation='vertical')
 plt.show()
 
 
-from scipy.spatial import cKDTree
+from training.metrics import knn_accuracy
+from training.annIndex import IvfPqIndex
+from training.distanceStats import pairSquaredDistances, meanSquaredDistances
 #Let us analyze the distance in the original space:
 Z = embeddings[0]
 X = embeddings[1]
 Y = embeddings[2]
 
-distance_bertSpace = np.sum(np.square(X-Y),axis=1)
-distance_bertSpace_link_text = np.sum(np.square(Z-Y),axis=1)
-mean_distance_xToY = np.zeros(X.shape[0])
-for idx in tqdm(range(0,X.shape[0])):
-    mean_distance_xToY[idx] = np.mean(np.sum(np.square(X[idx]-Y),axis=1))
+distance_bertSpace = pairSquaredDistances(X,Y)
+distance_bertSpace_link_text = pairSquaredDistances(Z,Y)
+mean_distance_xToY = meanSquaredDistances(X,Y)
 hist_distance_bertSpace_link_text = np.histogram(distance_bertSpace_link_text,bins=100)
 hist_distance_bertSpace = np.histogram(distance_bertSpace,bins=100)
 hist_mean_distance_xToY = np.histogram(mean_distance_xToY,bins=100)
@@ -83,10 +82,8 @@ plt.ylabel("count")
 plt.legend()
 plt.show()
 
-distance_CCASpace = np.sum(np.square(X_c-Y_c),axis=1)
-mean_distance_xToY = np.zeros(X.shape[0])
-for idx in tqdm(range(0,X_c.shape[0])):
-    mean_distance_xToY[idx] = np.mean(np.sum(np.square(X_c[idx]-Y_c),axis=1))
+distance_CCASpace = pairSquaredDistances(X_c,Y_c)
+mean_distance_xToY = meanSquaredDistances(X_c,Y_c)
 hist_distance_CCA = np.histogram(np.log(distance_CCASpace),bins=100)
 hist_mean_distance_xToY = np.histogram(np.log(mean_distance_xToY),bins=100)
 plt.bar(hist_distance_CCA[1][:-1],hist_distance_CCA[0],color="black",label="link context to target")
@@ -99,18 +96,9 @@ plt.show()
 
 
 #Let us compute the k-accuracy for k in [1,5,10,50]
-Y_tree = cKDTree(Y_c)
 k_values = [1,5,10,50]
-scores = []
-for k in k_values:
-    queryResultd,queryResultIdx = Y_tree.query(X_c,k)
-    indexRange = np.column_stack([np.arange(0,X_c.shape[0]) for _ in range(0,k)])
-    if k>1:
-        boolean = (queryResultIdx==indexRange)
-        scores += [np.sum(np.sum(boolean,axis=1))/X_c.shape[0]]
-    else:
-        boolean = queryResultIdx==np.squeeze(indexRange)
-        scores += [np.sum(boolean)/X_c.shape[0]]
+scores,mrr = knn_accuracy(X_c,Y_c,k_values)
+print("CCA 2-dimension MRR@50:",mrr)
 plt.bar(range(1,5),scores)
 plt.xticks(range(1,5),k_values)
 plt.xlabel("k-neighbor selected")
@@ -120,18 +108,10 @@ plt.show()
 #Same but for the bert embedding dataset...
 X = embeddings[1]
 Y = embeddings[2]
-Y_tree_bert = cKDTree(Y)
-k_values = [1,5,10,50]
-scores = []
-for k in k_values:
-    queryResultd,queryResultIdx = Y_tree_bert.query(X,k)
-    indexRange = np.column_stack([np.arange(0,X.shape[0]) for _ in range(0,k)])
-    if k>1:
-        boolean = (queryResultIdx==indexRange)
-        scores += [np.sum(np.sum(boolean,axis=1))/X.shape[0]]
-    else:
-        boolean = queryResultIdx==np.squeeze(indexRange)
-        scores += [np.sum(boolean)/X.shape[0]]
+#A KD-tree degenerates to a full scan in 768 dimensions: approximate index instead (see annIndex.py, benchmarkAnn.py)
+Y_index_bert = IvfPqIndex.build(Y)
+scores,mrr = knn_accuracy(X,Y_index_bert,k_values)
+print("bert space MRR@50:",mrr)
 plt.bar(range(1,5),scores)
 plt.xticks(range(1,5),k_values)
 plt.xlabel("k-neighbor selected")
@@ -141,7 +121,8 @@ plt.show()
 import torch
 from torch import nn
 
-def train(inputX,inputY,text):
+device = "cuda" if torch.cuda.is_available() else "cpu"
+def train(inputX,inputY,text,device=device):
     model = nn.Sequential(
         nn.Linear(2,100,bias=True),
         nn.Tanh(),
@@ -151,17 +132,17 @@ def train(inputX,inputY,text):
         nn.Tanh(),
         nn.Linear(100,2)
     )
-    model.to("cuda")
+    model.to(device)
     model = model.float()
     X_c_train = inputX[:-100,:]
     Y_c_train = inputY[:-100,:]
     nb_batches = 10
     X_c_train_batch = np.stack(np.split(X_c_train,nb_batches,axis=0))
     Y_c_train_batch = np.stack(np.split(Y_c_train,nb_batches,axis=0))
-    context = torch.tensor(X_c_train_batch,dtype=torch.float32).to("cuda")
-    target = torch.tensor(Y_c_train_batch,dtype=torch.float32).to("cuda")
-    context_test = torch.tensor(inputX[-100:,:],dtype=torch.float32).to("cuda")
-    target_test = torch.tensor(inputY[-100:,:],dtype=torch.float32).to("cuda")
+    context = torch.tensor(X_c_train_batch,dtype=torch.float32).to(device)
+    target = torch.tensor(Y_c_train_batch,dtype=torch.float32).to(device)
+    context_test = torch.tensor(inputX[-100:,:],dtype=torch.float32).to(device)
+    target_test = torch.tensor(inputY[-100:,:],dtype=torch.float32).to(device)
     loss_fn = torch.nn.MSELoss()
     optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
     nbEpoch = 1000
@@ -178,25 +159,16 @@ def train(inputX,inputY,text):
             print(loss_fn(output_test,target_test))
 
     def evaluateKNN(X,Y,text):
-        Y_tree_bert = cKDTree(Y)
         k_values = [1,5,10,50]
-        scores = []
-        for k in k_values:
-            queryResultd,queryResultIdx = Y_tree_bert.query(X,k)
-            indexRange = np.column_stack([np.arange(0,X.shape[0]) for _ in range(0,k)])
-            if k>1:
-                boolean = (queryResultIdx==indexRange)
-                scores += [np.sum(np.sum(boolean,axis=1))/X.shape[0]]
-            else:
-                boolean = queryResultIdx==np.squeeze(indexRange)
-                scores += [np.sum(boolean)/X.shape[0]]
+        scores,mrr = knn_accuracy(X,Y,k_values)
+        print(text,"MRR@50:",mrr)
         plt.bar(range(1,5),scores)
         plt.xticks(range(1,5),k_values)
         plt.xlabel("k-neighbor selected")
         plt.ylabel(text)
         plt.show()
 
-    X_full = torch.tensor(inputX,dtype=torch.float32).to('cuda')
+    X_full = torch.tensor(inputX,dtype=torch.float32).to(device)
     Y_full = inputY
     output = model(X_full).detach().cpu()
     evaluateKNN(output,Y_full,"distance in "+str(text)+" space")
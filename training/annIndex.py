@@ -0,0 +1,183 @@
+"""
+Approximate nearest neighbor index (IVF-PQ) for the 768-dimensional BERT vectors.
+
+A KD-tree does not prune anything at this dimensionality, so cKDTree ends up comparing every query with every
+document. The inverted file with product quantization (IVF-PQ) trades a little recall for a much smaller scan:
+    - a coarse k-means splits the documents in nLists lists, a query only scans the nProbe lists of the closest
+      centroids,
+    - the residual of each document to its centroid is split in nSubspaces subvectors, each one encoded by the id
+      (one byte) of its nearest centroid in a k-means codebook of 256 subvectors,
+    - the distance of a query to the documents of a list is the sum, over the subspaces, of a lookup in the
+      (nSubspaces,256) table of distances between the query residual and the codebooks.
+The approximate candidates can be re-ranked with the exact distances when the original vectors are given.
+IvfPqIndex.query has the (distances, ids) interface of cKDTree.query, so metrics.knn_accuracy accepts either.
+See benchmarkAnn.py for the recall vs latency trade-off against the exact search.
+"""
+import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from training.exactKnn import squaredDistances, gatheredDistances
+
+formatVersion = 1
+
+
+def assign(X, C, blockSize=4096):
+    """Index of the nearest row of C for every row of X."""
+    return np.concatenate([np.argmin(squaredDistances(X[b:b + blockSize], C), axis=1)
+                           for b in range(0, X.shape[0], blockSize)])
+
+
+def kmeans(X, nClusters, iterations=20, rng=None):
+    """Lloyd's k-means of the rows of X; an empty cluster is reseeded with a random row."""
+    rng = np.random.default_rng(rng)
+    C = X[rng.choice(X.shape[0], nClusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(X, C)
+        counts = np.bincount(labels, minlength=nClusters)
+        sums = csr_matrix((np.ones(X.shape[0], dtype=X.dtype), (labels, np.arange(X.shape[0]))),
+                          shape=(nClusters, X.shape[0])) @ X
+        empty = counts == 0
+        C[~empty] = sums[~empty] / counts[~empty, None]
+        C[empty] = X[rng.choice(X.shape[0], int(np.sum(empty)), replace=False)]
+    return C
+
+
+def defaultSubspaces(dim):
+    """The largest number of subspaces dividing dim with subvectors of at least 8 dimensions."""
+    return max([m for m in range(1, dim + 1) if dim % m == 0 and dim // m >= min(8, dim)])
+
+
+class IvfPqIndex():
+    def __init__(self, centroids, codebooks, codes, listIndptr, listIds, nProbe=8, vectors=None):
+        #centroids: (nLists,dim) coarse centroids. codebooks: (nSubspaces,nCodes,dim//nSubspaces).
+        #codes: (n,nSubspaces) uint8 codes of the residuals, sorted by list: list l is rows listIndptr[l]:listIndptr[l+1],
+        #listIds: the document id of every row of codes.
+        #vectors: the original (n,dim) vectors, optional, used to re-rank the candidates exactly.
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.listIndptr = listIndptr
+        self.listIds = listIds
+        self.nProbe = nProbe
+        self.vectors = vectors
+        self.codebookNorms = np.sum(np.square(codebooks), axis=2)
+
+    @classmethod
+    def build(cls, data, nLists=None, nSubspaces=None, nCodes=256, trainSize=65536, iterations=20, nProbe=8,
+              keepVectors=True, seed=0):
+        """
+        Train the coarse quantizer and the codebooks on a sample of trainSize rows of data, then encode every row.
+        nLists defaults to 4*sqrt(n), nSubspaces to subvectors of 8 dimensions.
+        """
+        rng = np.random.default_rng(seed)
+        n, dim = data.shape
+        if nLists is None:
+            nLists = int(4 * np.sqrt(n))
+        if nSubspaces is None:
+            nSubspaces = defaultSubspaces(dim)
+        if dim % nSubspaces != 0:
+            raise ValueError("nSubspaces=" + str(nSubspaces) + " does not divide the dimension " + str(dim))
+        nLists = max(1, min(nLists, n))
+        sample = np.asarray(data[np.sort(rng.choice(n, min(n, trainSize), replace=False))], dtype=np.float32)
+        nCodes = min(nCodes, 256, sample.shape[0])
+        centroids = kmeans(sample, nLists, iterations, rng)
+        residuals = (sample - centroids[assign(sample, centroids)]).reshape(sample.shape[0], nSubspaces, -1)
+        codebooks = np.stack([kmeans(residuals[:, j], nCodes, iterations, rng) for j in range(nSubspaces)])
+        labels = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, nSubspaces), dtype=np.uint8)
+        for b in range(0, n, 65536):
+            block = np.asarray(data[b:b + 65536], dtype=np.float32)
+            labels[b:b + block.shape[0]] = assign(block, centroids)
+            r = (block - centroids[labels[b:b + block.shape[0]]]).reshape(block.shape[0], nSubspaces, -1)
+            for j in range(nSubspaces):
+                codes[b:b + block.shape[0], j] = assign(r[:, j], codebooks[j])
+        order = np.argsort(labels, kind="stable")
+        listIndptr = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nLists))])
+        return cls(centroids, codebooks, codes[order], listIndptr, order, nProbe, data if keepVectors else None)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def queryBlock(self, Q, k, nProbe, rerank):
+        nSubspaces = self.codebooks.shape[0]
+        width = k * rerank if self.vectors is not None and rerank > 1 else k
+        bestDist = np.full((Q.shape[0], width), np.inf, dtype=np.float32)
+        bestIds = np.full((Q.shape[0], width), len(self), dtype=np.int64)
+        probes = np.argsort(squaredDistances(Q, self.centroids), axis=1)[:, :nProbe]
+        for l in np.unique(probes):
+            start, end = self.listIndptr[l], self.listIndptr[l + 1]
+            if start == end:
+                continue
+            sel = np.nonzero(np.any(probes == l, axis=1))[0]
+            r = (Q[sel] - self.centroids[l]).reshape(sel.shape[0], nSubspaces, -1)
+            #distance tables (nSubspaces,queries,nCodes) between the query residuals and the codebooks
+            r = r.transpose(1, 0, 2)
+            tables = (np.sum(np.square(r), axis=2)[:, :, None] - 2 * (r @ self.codebooks.transpose(0, 2, 1))
+                      + self.codebookNorms[:, None, :])
+            codes = self.codes[start:end]
+            dist = np.zeros((sel.shape[0], end - start), dtype=np.float32)
+            for j in range(nSubspaces):
+                dist += tables[j][:, codes[:, j]]
+            allDist = np.concatenate([bestDist[sel], dist], axis=1)
+            allIds = np.concatenate([bestIds[sel], np.broadcast_to(self.listIds[start:end], dist.shape)], axis=1)
+            keep = np.argpartition(allDist, width - 1, axis=1)[:, :width]
+            bestDist[sel] = np.take_along_axis(allDist, keep, axis=1)
+            bestIds[sel] = np.take_along_axis(allIds, keep, axis=1)
+        valid = bestIds < len(self)
+        if width > k and valid.any():
+            #exact distances of the candidates (the padding ids get an infinite distance)
+            candidates = np.asarray(self.vectors[np.unique(bestIds[valid])], dtype=np.float32)
+            position = np.searchsorted(np.unique(bestIds[valid]), np.where(valid, bestIds, 0))
+            bestDist = np.where(valid, gatheredDistances(Q, candidates, position), np.inf)
+        order = np.argsort(bestDist, axis=1, kind="stable")[:, :k]
+        return np.sqrt(np.take_along_axis(bestDist, order, axis=1)), np.take_along_axis(bestIds, order, axis=1)
+
+    def query(self, X, k=1, nProbe=None, rerank=4, workers=-1, blockSize=1024):
+        """
+        (distances, ids) of the (approximate) k nearest documents of every row of X, closest first, like
+        cKDTree.query: missing neighbors have an infinite distance and the id len(self).
+        nProbe: number of lists scanned per query (default: self.nProbe). With the original vectors, rerank*k
+        candidates are re-ranked with the exact distances. Blocks of queries run on workers threads (-1: every core).
+        """
+        X = np.asarray(X, dtype=np.float32)
+        squeeze = X.ndim == 1
+        X = np.atleast_2d(X)
+        nProbe = min(self.nProbe if nProbe is None else nProbe, self.centroids.shape[0])
+        if workers is None or workers < 1:
+            workers = os.cpu_count()
+        blocks = range(0, X.shape[0], blockSize)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda b: self.queryBlock(X[b:b + blockSize], k, nProbe, rerank), blocks))
+        distances = np.concatenate([d for d, _ in results]) if results else np.empty((0, k))
+        ids = np.concatenate([i for _, i in results]) if results else np.empty((0, k), dtype=np.int64)
+        if k == 1:
+            distances, ids = distances[:, 0], ids[:, 0]
+        if squeeze:
+            distances, ids = distances[0], ids[0]
+        return distances, ids
+
+    def save(self, path):
+        """Write the index into the directory path (the original vectors are not saved, see load)."""
+        tmp = path + ".tmp" + str(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name in ["centroids", "codebooks", "codes", "listIndptr", "listIds"]:
+            np.save(os.path.join(tmp, name + ".npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(tmp, "index.json"), "w") as f:
+            json.dump({"version": formatVersion, "nProbe": int(self.nProbe)}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, vectors=None):
+        """Memory-map the index saved at path; vectors: the original vectors, to re-rank the candidates."""
+        with open(os.path.join(path, "index.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != formatVersion:
+            raise ValueError("index at " + path + " has format version " + str(meta["version"]))
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                  for name in ["centroids", "codebooks", "codes", "listIndptr", "listIds"]]
+        return cls(*arrays, meta["nProbe"], vectors)
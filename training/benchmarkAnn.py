@@ -0,0 +1,47 @@
+"""
+Benchmark of the approximate nearest neighbor index (see annIndex.py) against the exact search (exactKnn.py).
+
+The link contexts of data3 query the target contexts in BERT space. For several nProbe (lists scanned per query),
+with and without exact re-ranking of the candidates, we measure the query latency, the recall@10 of the exact 10
+nearest targets, and the k-accuracy of the link context retrieving its own target.
+argv[1]: number of rows used (default: every row).
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from training import dataCache
+from training.annIndex import IvfPqIndex
+from training.exactKnn import ExactKnn
+
+nrows = int(sys.argv[1]) if len(sys.argv) > 1 else None
+X = np.asarray(dataCache.readEmbedding(os.path.join("data3", "link_context.emb"), nrows), dtype=np.float32)
+Y = np.asarray(dataCache.readEmbedding(os.path.join("data3", "target_context.emb"), nrows), dtype=np.float32)
+k = 10
+K = [1, 5, 10]
+
+start = time.perf_counter()
+_, exactIds = ExactKnn(Y).query(X, k)
+exactTime = time.perf_counter() - start
+hit = exactIds == np.arange(X.shape[0])[:, None]
+results = [{"search": "exact", "nProbe": "", "rerank": "",
+            "ms/query": 1000 * exactTime / X.shape[0], "recall@10": 1.0}]
+results[0].update({"acc@" + str(kk): np.mean(np.any(hit[:, :kk], axis=1)) for kk in K})
+
+start = time.perf_counter()
+index = IvfPqIndex.build(Y)
+print("index of", Y.shape[0], "vectors:", index.centroids.shape[0], "lists,", index.codebooks.shape[0],
+      "subspaces, built in %.1fs" % (time.perf_counter() - start))
+for nProbe in [1, 2, 4, 8, 16, 32]:
+    for rerank in [1, 4]:
+        start = time.perf_counter()
+        _, ids = index.query(X, k, nProbe=nProbe, rerank=rerank)
+        elapsed = time.perf_counter() - start
+        recall = np.mean(np.sum(ids[:, :, None] == exactIds[:, None, :], axis=(1, 2)) / k)
+        hit = ids == np.arange(X.shape[0])[:, None]
+        row = {"search": "ivf-pq", "nProbe": nProbe, "rerank": rerank,
+               "ms/query": 1000 * elapsed / X.shape[0], "recall@10": recall}
+        row.update({"acc@" + str(kk): np.mean(np.any(hit[:, :kk], axis=1)) for kk in K})
+        results += [row]
+print(pd.DataFrame(results).to_string(index=False))
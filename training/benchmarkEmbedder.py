@@ -0,0 +1,55 @@
+"""
+Benchmark of the cpu backend of BertEmbedder (see embeddingPipeline.py).
+
+For the fp32 model and its dynamically quantized int8 version, and for a few intra-op thread counts, we measure
+the throughput (sequences/s) on the link texts and contexts of links_with_top_k_count_search_candidates.tsv, in the
+preprocessing folder, whose columns are aligned (pretty_links_sample.tsv is laid out for reading: its rows have fewer
+tab-separated fields than its header, so read_csv puts document paths in its context columns).
+The drift of each configuration is measured against the fp32 embeddings: cosine similarity and relative L2 error
+per sequence, and agreement of the nearest target context of each link context.
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import torch
+from training.embeddingPipeline import BertEmbedder
+from training.exactKnn import ExactKnn
+
+modelName = sys.argv[1] if len(sys.argv) > 1 else "bert-base-uncased"
+sampleFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing")
+data = pd.read_csv(os.path.join(sampleFolder, "links_with_top_k_count_search_candidates.tsv"), sep="\t")
+linkContexts = [str(c).strip() for c in data["source_context"].values]
+targetContexts = [str(c).strip() for c in data["target_context"].values]
+texts = [str(c).strip() for c in data["link_text"].values] + linkContexts + targetContexts
+nbLinks = len(linkContexts)
+
+threadCounts = sorted(set([1, 4, os.cpu_count()]))
+results = []
+reference = None
+for quantize in [False, True]:
+    embedder = BertEmbedder(modelName, device="cpu", quantize=quantize)
+    for threads in threadCounts:
+        torch.set_num_threads(threads)
+        embedder.encode(texts[:8])  # warm-up
+        start = time.perf_counter()
+        vectors = embedder.encode(texts)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = vectors
+        cosine = np.sum(vectors * reference, axis=1) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1))
+        relative = np.linalg.norm(vectors - reference, axis=1) / np.linalg.norm(reference, axis=1)
+        # retrieval: nearest target context of every link context, compared with the fp32 answer
+        links, targets = vectors[-2 * nbLinks:-nbLinks], vectors[-nbLinks:]
+        refLinks, refTargets = reference[-2 * nbLinks:-nbLinks], reference[-nbLinks:]
+        _, nearest = ExactKnn(targets).query(links)
+        _, refNearest = ExactKnn(refTargets).query(refLinks)
+        results += [{"model": "int8" if quantize else "fp32",
+                     "threads": threads,
+                     "sequences/s": len(texts) / elapsed,
+                     "mean cosine": np.mean(cosine),
+                     "min cosine": np.min(cosine),
+                     "mean relative L2": np.mean(relative),
+                     "nearest target agreement": np.mean(nearest == refNearest)}]
+print(pd.DataFrame(results).to_string(index=False))
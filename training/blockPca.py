@@ -0,0 +1,76 @@
+"""
+PCA accumulated over blocks of rows, for embeddings that do not fit in memory.
+
+The mean and the d x d scatter matrix are accumulated in float64 in one pass over blocks of rows (the input can be a
+memory-mapped embedding: O(d^2) memory whatever the number of rows), and a single eigendecomposition of the
+covariance gives every component, sorted by explained variance. The components are nested: the first k are the PCA
+of rank k, so transform(X, n_components=k) serves any rank (and whitening) from one fit, and score() evaluates the
+probabilistic PCA likelihood of every rank from a single projection.
+For the 768-dimensional embeddings, the covariance is small and its exact eigendecomposition is cheaper than a
+randomized SVD or an IncrementalPCA over the same blocks.
+"""
+import numpy as np
+
+
+class BlockPCA():
+    def __init__(self, n_components=2, whiten=False, blockSize=65536):
+        self.n_components = n_components
+        self.whiten = whiten
+        self.blockSize = blockSize
+
+    def fit(self, X):
+        n = X.shape[0]
+        shift = np.mean(np.asarray(X[:self.blockSize], dtype=np.float64), axis=0)
+        s = np.zeros(X.shape[1])
+        scatter = np.zeros((X.shape[1], X.shape[1]))
+        for b in range(0, n, self.blockSize):
+            x = np.asarray(X[b:b + self.blockSize], dtype=np.float64) - shift
+            s += np.sum(x, axis=0)
+            scatter += x.T @ x
+        m = s / n
+        covariance = (scatter / n - np.outer(m, m)) * n / max(n - 1, 1)
+        variances, vectors = np.linalg.eigh(covariance)
+        order = np.argsort(variances)[::-1]
+        self.mean_ = shift + m
+        self.explained_variance_ = np.maximum(variances[order], 0)
+        self.explained_variance_ratio_ = self.explained_variance_ / max(np.sum(self.explained_variance_), 1e-300)
+        # sign convention: the largest coordinate of each component is positive
+        components = vectors[:, order].T
+        signs = np.sign(components[np.arange(components.shape[0]), np.argmax(np.abs(components), axis=1)])
+        self.components_ = components * np.where(signs == 0, 1, signs)[:, None]
+        self.n_samples_ = n
+        return self
+
+    def transform(self, X, n_components=None, whiten=None):
+        """Projection of X on the first n_components (default: self.n_components), optionally whitened."""
+        k = self.n_components if n_components is None else n_components
+        whiten = self.whiten if whiten is None else whiten
+        weights = self.components_[:k].T
+        if whiten:
+            weights = weights / np.sqrt(np.maximum(self.explained_variance_[:k], 1e-300))
+        return np.concatenate([(np.asarray(X[b:b + self.blockSize], dtype=np.float64) - self.mean_) @ weights
+                               for b in range(0, X.shape[0], self.blockSize)])
+
+    def score(self, X, ranks):
+        """
+        Mean log-likelihood of the rows of X under the probabilistic PCA of rank k (like sklearn's PCA.score), for
+        every k of ranks. The noise variance of rank k is the mean of the remaining variances. Whitening does not
+        change the model, hence the score.
+        """
+        d = self.components_.shape[0]
+        kMax = max(ranks)
+        variances = self.explained_variance_[:min(self.n_samples_, d)]
+        logLikelihood = np.zeros(len(ranks))
+        for b in range(0, X.shape[0], self.blockSize):
+            x = np.asarray(X[b:b + self.blockSize], dtype=np.float64) - self.mean_
+            z2 = np.square(x @ self.components_[:kMax].T)
+            norm2 = np.sum(np.square(x), axis=1)
+            for i, k in enumerate(ranks):
+                noise = max(np.mean(variances[k:]) if k < variances.shape[0] else 0.0, 1e-300)
+                mahalanobis = np.sum(z2[:, :k] / variances[:k], axis=1) + (norm2 - np.sum(z2[:, :k], axis=1)) / noise
+                logDet = np.sum(np.log(variances[:k])) + (d - k) * np.log(noise)
+                logLikelihood[i] += np.sum(-0.5 * (mahalanobis + logDet + d * np.log(2 * np.pi)))
+        return logLikelihood / X.shape[0]
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
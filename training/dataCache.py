@@ -0,0 +1,113 @@
+"""
+Shared access to the data3 files, through a binary cache next to them.
+
+Parsing exact_hits.csv and the 768-column embedding csv files is most of the startup time of the scripts.
+The first read of a file converts it once:
+    - the text table (exact_hits.csv) into an uncompressed Arrow IPC file, memory-mapped back with pyarrow. Every
+      column is read as a string, in blocks streamed to the file: type inference per chunk would mix ints and
+      strings in a column whose first values look numeric,
+    - an embedding csv (written by DataFrame.to_csv, so with the index as first column) into a float32 .npy matrix,
+      opened with mmap_mode="r".
+Later reads only map the binary file and slice it without copy. Each cache file stores the size and modification
+time of its source, a cache whose source changed is stale and rebuilt.
+Embeddings already written as an embedding store (.emb, see embeddingStore.py) are mapped directly.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from training.embeddingStore import EmbeddingStore
+
+cacheDirName = "cache"
+hitsVersion = 2  # format of the exact_hits cache, 2: every column is a string
+
+
+def cachePath(path, extension):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, cacheDirName, os.path.splitext(name)[0] + extension)
+
+
+def sourceStamp(path, version=None):
+    stat = os.stat(path)
+    stamp = {"source": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if version is not None:
+        stamp["version"] = version
+    return stamp
+
+
+def isFresh(path, cached, version=None):
+    """True if the cache file exists and was converted from the current version of path (in format version)."""
+    try:
+        with open(cached + ".json") as f:
+            return json.load(f) == sourceStamp(path, version) and os.path.exists(cached)
+    except (OSError, ValueError):
+        return False
+
+
+def markFresh(path, cached, version=None):
+    with open(cached + ".json", "w") as f:
+        json.dump(sourceStamp(path, version), f)
+
+
+def readHits(path=os.path.join("data3", "exact_hits.csv"), nrows=None):
+    """The exact_hits table as a DataFrame, like pd.read_csv(path,sep="\t",nrows=nrows)."""
+    return readHitsTable(path, nrows).to_pandas()
+
+
+def readHitsTable(path=os.path.join("data3", "exact_hits.csv"), nrows=None):
+    """The exact_hits table as a memory-mapped pyarrow Table (slicing it does not copy)."""
+    cached = cachePath(path, ".arrow")
+    if not isFresh(path, cached, hitsVersion):
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        header = pd.read_csv(path, sep="\t", nrows=0)
+        reader = pacsv.open_csv(path, parse_options=pacsv.ParseOptions(delimiter="\t", newlines_in_values=True),
+                                convert_options=pacsv.ConvertOptions(
+                                    column_types={c: pa.string() for c in header.columns},
+                                    strings_can_be_null=True))
+        tmp = cached + ".tmp"
+        with pa.OSFile(tmp, "wb") as sink:
+            with pa.ipc.new_file(sink, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+        os.replace(tmp, cached)
+        markFresh(path, cached, hitsVersion)
+    table = pa.ipc.open_file(pa.memory_map(cached, "r")).read_all()
+    if nrows is not None:
+        table = table.slice(0, nrows)
+    return table
+
+
+def readEmbedding(path, nrows=None, chunksize=10000):
+    """
+    The embedding matrix of a csv written by DataFrame.to_csv (index column dropped), as a float32 memmap.
+    Equivalent to pd.read_csv(path,nrows=nrows).values[:,1:], without parsing the csv again after the first call.
+    A .emb path is opened as an embedding store, rows sorted by row id.
+    """
+    if path.endswith(".emb"):
+        store = EmbeddingStore(path)
+        matrix = store.vectors
+        if np.any(np.diff(store.ids) < 0):
+            matrix = store.inRowOrder()
+        return matrix[:nrows] if nrows is not None else matrix
+    cached = cachePath(path, ".npy")
+    if not isFresh(path, cached):
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        with open(path, "rb") as f:
+            nbRows = sum(1 for _ in f) - 1  # numeric csv: one line per row, plus the header
+        header = pd.read_csv(path, nrows=0)
+        tmp = cached + ".tmp.npy"
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(nbRows, header.shape[1] - 1))
+        start = 0
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            out[start:start + chunk.shape[0]] = chunk.values[:, 1:]
+            start += chunk.shape[0]
+        out.flush()
+        del out
+        os.replace(tmp, cached)
+        markFresh(path, cached)
+    matrix = np.load(cached, mmap_mode="r")
+    if nrows is not None:
+        matrix = matrix[:nrows]
+    return matrix
@@ -0,0 +1,39 @@
+"""
+Distance statistics between two embeddings X and Y of the same rows (link contexts and their targets).
+
+The mean squared distance from x to every y does not need the distances themselves:
+    mean_j |x - y_j|^2 = |x|^2 - 2 x.mean(Y) + mean_j |y_j|^2
+so it costs O(n.d) instead of O(n^2.d), from the mean vector and the mean squared norm of Y.
+Everything is accumulated in float64 over blocks of rows, so X and Y can be memory-mapped embeddings.
+"""
+import numpy as np
+
+
+def moments(Y, blockSize=65536):
+    """Mean vector and mean squared norm of the rows of Y."""
+    total = np.zeros(Y.shape[1])
+    totalNorm = 0.0
+    for b in range(0, Y.shape[0], blockSize):
+        block = np.asarray(Y[b:b + blockSize], dtype=np.float64)
+        total += np.sum(block, axis=0)
+        totalNorm += np.sum(np.square(block))
+    return total / Y.shape[0], totalNorm / Y.shape[0]
+
+
+def meanSquaredDistances(X, Y, blockSize=65536):
+    """For every row x of X, the mean over the rows y of Y of |x - y|^2."""
+    mean, meanNorm = moments(Y, blockSize)
+    out = np.empty(X.shape[0])
+    for b in range(0, X.shape[0], blockSize):
+        block = np.asarray(X[b:b + blockSize], dtype=np.float64)
+        out[b:b + block.shape[0]] = np.sum(np.square(block), axis=1) - 2 * (block @ mean) + meanNorm
+    return np.maximum(out, 0)
+
+
+def pairSquaredDistances(X, Y, blockSize=65536):
+    """|X[i] - Y[i]|^2 for every row i."""
+    out = np.empty(X.shape[0])
+    for b in range(0, X.shape[0], blockSize):
+        out[b:b + blockSize] = np.sum(np.square(np.asarray(X[b:b + blockSize], dtype=np.float64) -
+                                                np.asarray(Y[b:b + blockSize], dtype=np.float64)), axis=1)
+    return out
@@ -5,27 +5,35 @@ The model produces embedding for the document but also for each word !
 import gensim
 import pandas as pd
 import os
-from tqdm import tqdm
+from training import dataCache
+from training.tokenCorpus import TokenCorpus, TaggedTokenCorpus
 
 restrictSize = 10000
-class MyCorpus(object):
-    """An interator that yields sentences (lists of str)."""
-    def __init__(self):
-        self.data =pd.read_csv(os.path.join("data3","exact_hits.csv"),sep="\t",nrows=restrictSize)
-    def __iter__(self):
-        target_context_data = self.data.values[:restrictSize,2]
-
-        for i,line in enumerate(target_context_data):
-            # assume there's one document per line, tokens separated by whitespace ... #todo: use bert tokenization? to have sound comparisons....
-            tokens = gensim.utils.simple_preprocess(line)
-            yield gensim.models.doc2vec.TaggedDocument(tokens, [i])
-
-train_corpus = MyCorpus()
-model = gensim.models.doc2vec.Doc2Vec(vector_size = 100, min_count= 2,epochs = 40)
-model.build_vocab(train_corpus)
-print("created vocab ")
-model.train(train_corpus,total_examples = model.corpus_count, epochs = model.epochs)
-print("ended training")
+data = dataCache.readHits(nrows=restrictSize)
+# The target contexts are tokenized once into a binary token corpus (see tokenCorpus.py), rebuilt only when
+# exact_hits.csv changes. #todo: use bert tokenization? to have sound comparisons....
+# Documents are tagged by their row, which is also their line in the corpus_file used for training:
+# gensim then reads it in its worker threads, without the python iterator.
+hits_path = os.path.join("data3","exact_hits.csv")
+train_corpus = TaggedTokenCorpus(TokenCorpus.cached(os.path.join("data3","cache","target_context_"+str(restrictSize)),
+                                                    hits_path,lambda: data.values[:,2]))
+# saved so that the inference workers can share it read-only through mmap (see doc2vecInference.py).
+# The multi-threaded training is not deterministic: the saved model is reused as long as the corpus and the parameters
+# are unchanged, so that its fingerprint (the key of the inferred vectors in the cache below) stays the same.
+model_path = os.path.join("data3","doc2vec.model")
+model_params = dict(vector_size = 100, min_count= 2,epochs = 40)
+if dataCache.isFresh(train_corpus.corpusFile,model_path,model_params):
+    model = gensim.models.doc2vec.Doc2Vec.load(model_path)
+    print("loaded",model_path)
+else:
+    model = gensim.models.doc2vec.Doc2Vec(**model_params,workers = os.cpu_count())
+    model.build_vocab(corpus_file=train_corpus.corpusFile)
+    print("created vocab ")
+    model.train(corpus_file=train_corpus.corpusFile,total_examples = model.corpus_count,
+                total_words = model.corpus_total_words, epochs = model.epochs)
+    print("ended training")
+    model.save(model_path)
+    dataCache.markFresh(train_corpus.corpusFile,model_path,model_params)
 
 from sklearn.manifold import TSNE                   # final reduction
 import numpy as np                                  # array handling
@@ -45,7 +53,7 @@ import matplotlib.pyplot as plt
 from matplotlib.cm import get_cmap
 import random
 
-target_link_data = train_corpus.data.values[:restrictSize,3]
+target_link_data = data.values[:restrictSize,3]
 target_names = np.array([str(c).split(".tgz!")[0] for c in target_link_data])
 unique_database = np.unique(target_names)
 # For every text_link, we assign to it a label that corresponds to its unique_database
@@ -65,7 +73,7 @@ for idx,base in  enumerate(unique_database):
 class MyLinkContextCorpus(object):
     """An interator that yields sentences (lists of str)."""
     def __init__(self):
-        self.data =pd.read_csv(os.path.join("data3","exact_hits.csv"),sep="\t",nrows=restrictSize)
+        self.data = data
     def __iter__(self):
         link_context_data = self.data.values[:restrictSize,1]
         link_data = self.data.values[:restrictSize,0]
@@ -77,29 +85,37 @@ class MyLinkContextCorpus(object):
 
 link_text_corpus = MyLinkContextCorpus()
 iter_link_text_corpus = link_text_corpus.__iter__()
-embedded_lincontext_tbl = []
-for e in tqdm(iter_link_text_corpus):
-    embedded_lincontext_tbl += [model.infer_vector(e.words)]
-embedded_lincontext_tbl = np.array(embedded_lincontext_tbl)
+# Contexts repeat a lot: the inferred vectors are cached under (fingerprint of this trained model, token text),
+# only the contexts never seen by this model are inferred. A retrained model gets a new fingerprint: the vectors of
+# the previous one are then never read again (delete embeddings.sqlite to reclaim the space).
+import hashlib
+import multiprocessing
+from training.embeddingCache import EmbeddingCache
+from training.doc2vecInference import inferVectors
+model_fingerprint = hashlib.sha1(model.wv.vectors.tobytes()+model.docvecs.vectors_docs.tobytes()).hexdigest()
+cache = EmbeddingCache(os.path.join("data3","embeddings.sqlite"))
+link_context_texts = [" ".join(e.words) for e in iter_link_text_corpus]
+# The missing ones are inferred in parallel, each worker writing into one preallocated float32 matrix.
+# The inference needs fork: with spawn the worker processes would re-execute this script.
+inference_workers = os.cpu_count() if "fork" in multiprocessing.get_all_start_methods() else 1
+embedded_lincontext_tbl = cache.embed(link_context_texts,
+                                      lambda texts: np.array(inferVectors(model_path,[t.split() for t in texts],
+                                                                          os.path.join("data3","doc2vec_inferred.npy"),
+                                                                          workers=inference_workers)),
+                                      "doc2vec:"+model_fingerprint)
+print(cache.report())
 df_linkcontext = pd.DataFrame(embedded_lincontext_tbl)
 df_linkcontext.to_csv(os.path.join("data3","embedded_lincontext_tbl.csv"))
 
 
 from scipy.spatial import cKDTree
+from training.metrics import knn_accuracy
 #Without any TSNE embedding:
 #Let us compute the k-accuracy for k in [1,5,10,50]
 Y_tree = cKDTree(model.docvecs.vectors_docs)
 k_values = [1,5,10,50]
-scores = []
-for k in k_values:
-    queryResultd,queryResultIdx = Y_tree.query(embedded_lincontext_tbl,k)
-    indexRange = np.column_stack([np.arange(0,embedded_lincontext_tbl.shape[0]) for _ in range(0,k)])
-    if k>1:
-        boolean = (queryResultIdx==indexRange)
-        scores += [np.sum(np.sum(boolean,axis=1))/embedded_lincontext_tbl.shape[0]]
-    else:
-        boolean = queryResultIdx==np.squeeze(indexRange)
-        scores += [np.sum(boolean)/embedded_lincontext_tbl.shape[0]]
+scores,mrr = knn_accuracy(embedded_lincontext_tbl,Y_tree,k_values)
+print("doc2vec 100-dimension MRR@50:",mrr)
 plt.bar(range(1,5),scores)
 plt.xticks(range(1,5),k_values)
 plt.xlabel("k-neighbor selected")
@@ -109,16 +125,8 @@ plt.show()
 y_tsne = np.stack((x_vals,y_vals),axis=1)
 Y_tree_tsne = cKDTree(y_tsne)
 link_tsne = tsne.fit_transform(embedded_lincontext_tbl)
-scoresTSNE = []
-for k in k_values:
-    queryResultd,queryResultIdx = Y_tree_tsne.query(link_tsne,k)
-    indexRange = np.column_stack([np.arange(0,link_tsne.shape[0]) for _ in range(0,k)])
-    if k>1:
-        boolean = (queryResultIdx==indexRange)
-        scoresTSNE += [np.sum(np.sum(boolean,axis=1))/link_tsne.shape[0]]
-    else:
-        boolean = queryResultIdx==np.squeeze(indexRange)
-        scoresTSNE += [np.sum(boolean)/link_tsne.shape[0]]
+scoresTSNE,mrrTSNE = knn_accuracy(link_tsne,Y_tree_tsne,k_values)
+print("doc2vec TSNE 2-dimension MRR@50:",mrrTSNE)
 plt.bar(range(1,5),scoresTSNE)
 plt.xticks(range(1,5),k_values)
 plt.xlabel("k-neighbor selected")
@@ -0,0 +1,66 @@
+"""
+Parallel doc2vec inference.
+
+model.infer_vector is independent per document, so the documents are split in chunks inferred by a process pool.
+Each worker loads the saved model once with mmap="r", so the large arrays are shared read-only between the workers,
+and writes its vectors straight into a preallocated float32 .npy matrix opened as a memmap.
+Before each document the random generator of the model is reseeded from the seed and the words of the document:
+a document always gets the same vector, whatever the number of workers and the chunk it falls in.
+"""
+import os
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from gensim.models.doc2vec import Doc2Vec
+from tqdm import tqdm
+
+workerState = {}  # model and output matrix of the current worker process, opened once by initWorker
+
+
+def documentSeed(words, seed):
+    return (zlib.crc32(" ".join(words).encode("utf-8", "surrogatepass")) + seed) % 2 ** 32
+
+
+def initWorker(modelPath, outPath):
+    workerState["model"] = Doc2Vec.load(modelPath, mmap="r")
+    workerState["out"] = np.load(outPath, mmap_mode="r+")
+
+
+def inferChunk(start, documents, seed, epochs):
+    model, out = workerState["model"], workerState["out"]
+    for i, words in enumerate(documents):
+        model.random = np.random.RandomState(documentSeed(words, seed))
+        out[start + i] = model.infer_vector(words, epochs=epochs)
+    out.flush()
+    return len(documents)
+
+
+def inferVectors(modelPath, documents, outPath, workers=None, seed=0, chunkSize=500, epochs=None, display=True):
+    """
+    Infer the vector of every document (a list of words) with the doc2vec model saved at modelPath.
+    The (len(documents),vector_size) float32 matrix is written to outPath (.npy) and returned as a read-only memmap.
+    workers: number of processes (default: every core), 1 runs in the current process.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    model = Doc2Vec.load(modelPath, mmap="r")
+    out = np.lib.format.open_memmap(outPath, mode="w+", dtype=np.float32, shape=(len(documents), model.vector_size))
+    del out
+    chunks = [(start, list(documents[start:start + chunkSize])) for start in range(0, len(documents), chunkSize)]
+    progress = tqdm(total=len(documents), disable=not display)
+    if workers <= 1:
+        initWorker(modelPath, outPath)
+        for start, chunk in chunks:
+            progress.update(inferChunk(start, chunk, seed, epochs))
+    else:
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=initWorker, initargs=(modelPath, outPath)) as pool:
+            futures = [pool.submit(inferChunk, start, chunk, seed, epochs) for start, chunk in chunks]
+            for f in futures:
+                progress.update(f.result())
+    progress.close()
+    return np.load(outPath, mmap_mode="r")
@@ -0,0 +1,95 @@
+"""
+Persistent content-addressed cache of embeddings, in front of the embedders.
+
+Link texts and contexts repeat a lot across docsets (same API names, same boilerplate contexts), so every vector is
+stored in an SQLite table under sha1(model id, normalized text). The model id must identify everything the vector
+depends on: model name, pooling, quantization, or a fingerprint of a trained model.
+Only the texts missing from the cache (each distinct text once) are sent to the embedder, so re-running on an
+extended dataset costs only the new rows. hits and misses count the lookups, report() prints the hit rate.
+"""
+import sqlite3
+import hashlib
+import numpy as np
+
+
+def normalize(text):
+    """Whitespace-insensitive form of a text (both the BERT tokenizer and simple_preprocess ignore whitespace)."""
+    return " ".join(str(text).split())
+
+
+class EmbeddingCache():
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS vectors (key BLOB PRIMARY KEY, dtype TEXT, vector BLOB)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, modelId, text):
+        return hashlib.sha1((modelId + "\x00" + normalize(text)).encode("utf-8", "surrogatepass")).digest()
+
+    def get(self, keys, chunkSize=500):
+        """{key: vector} for the keys present in the cache."""
+        found = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), chunkSize):
+            chunk = keys[start:start + chunkSize]
+            rows = self.connection.execute("SELECT key, dtype, vector FROM vectors WHERE key IN (" +
+                                           ",".join("?" * len(chunk)) + ")", chunk)
+            for key, dtype, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=dtype)
+        return found
+
+    def put(self, keys, vectors):
+        vectors = np.asarray(vectors)
+        self.connection.executemany("INSERT OR REPLACE INTO vectors VALUES (?,?,?)",
+                                    [(k, vectors.dtype.name, np.ascontiguousarray(v).tobytes())
+                                     for k, v in zip(keys, vectors)])
+        self.connection.commit()
+
+    def stream(self, texts, embed, modelId, window=10000):
+        """
+        Yield (rowIds, vectors) runs in the order of texts, one per window of texts.
+        embed(list of texts) -> (n,dim) array is only called on the distinct texts of the window missing from the cache.
+        """
+        batch = []
+        start = 0
+        for text in texts:
+            batch += [text]
+            if len(batch) == window:
+                yield list(range(start, start + len(batch))), self.lookup(batch, embed, modelId)
+                start += len(batch)
+                batch = []
+        if batch:
+            yield list(range(start, start + len(batch))), self.lookup(batch, embed, modelId)
+
+    def lookup(self, texts, embed, modelId):
+        keys = [self.key(modelId, t) for t in texts]
+        found = self.get(keys)
+        missing = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in missing:
+                missing[k] = t
+        self.hits += sum(k in found for k in keys)
+        self.misses += len(keys) - sum(k in found for k in keys)
+        if missing:
+            vectors = np.asarray(embed(list(missing.values())))
+            self.put(list(missing.keys()), vectors)
+            found.update(zip(missing.keys(), vectors))
+        return np.stack([found[k] for k in keys])
+
+    def embed(self, texts, embed, modelId, window=10000):
+        """The (len(texts),dim) matrix of the cached or computed embeddings of texts."""
+        return np.concatenate([vectors for _, vectors in self.stream(texts, embed, modelId, window)])
+
+    def hitRate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def report(self):
+        return ("embedding cache: " + str(self.hits) + " hits / " + str(self.hits + self.misses) +
+                " lookups (" + "%.1f" % (100 * self.hitRate()) + "%)")
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,105 @@
+"""
+Resumable, sharded embedding jobs.
+
+The rows to embed are split into shards of shardSize rows. Shard i of the store <path> is embedded into
+<path>.shards/<i>.emb and marked done by <path>.shards/<i>.done once complete; <path>.shards/job.json records the
+parameters of the job (rows, shardSize, model, and the sha1 of the texts) so that shards of different jobs are never
+mixed: shards embedded from an older version of the texts are refused instead of being merged as if up to date.
+    - A restart skips the shards already done, an interrupted shard is recomputed from its start.
+    - Independent processes (or machines sharing the folder) can each run a disjoint range of shards.
+    - merge() concatenates the shards, once they are all done, into the embedding store <path>.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from tqdm import tqdm
+from training.embeddingStore import EmbeddingWriter, EmbeddingStore
+
+
+def shardFolder(path):
+    return path + ".shards"
+
+
+def shardPath(path, shard):
+    return os.path.join(shardFolder(path), "%05d" % shard)
+
+
+def shardCount(nbRows, shardSize):
+    return -(-nbRows // shardSize)
+
+
+def textsFingerprint(texts):
+    """sha1 of the sequence of texts."""
+    h = hashlib.sha1()
+    for text in texts:
+        h.update(str(text).encode("utf-8", "surrogatepass") + b"\x00")
+    return h.hexdigest()
+
+
+def writeJob(path, texts, shardSize, modelId):
+    """Create (or check) the job description of the shards of path."""
+    os.makedirs(shardFolder(path), exist_ok=True)
+    job = {"rows": len(texts), "shardSize": int(shardSize), "model": modelId, "texts": textsFingerprint(texts)}
+    jobPath = os.path.join(shardFolder(path), "job.json")
+    if os.path.exists(jobPath):
+        with open(jobPath) as f:
+            existing = json.load(f)
+        if existing != job:
+            raise ValueError("the shards in " + shardFolder(path) + " belong to another job: " + str(existing) +
+                             ", remove the folder to start " + str(job))
+    else:
+        tmp = jobPath + ".tmp" + str(os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp, jobPath)
+    return job
+
+
+def isDone(path, shard):
+    return os.path.exists(shardPath(path, shard) + ".done")
+
+
+def runShards(embedder, texts, path, shardSize=10000, shards=None, maxTokens=8192):
+    """
+    Embed the shards of texts that are not done yet into the shard folder of path.
+    shards: the shard numbers this process is responsible for (default: all of them).
+    Return the number of shards embedded by this call.
+    """
+    writeJob(path, texts, shardSize, embedder.modelId)
+    if shards is None:
+        shards = range(shardCount(len(texts), shardSize))
+    embedded = 0
+    for shard in shards:
+        if isDone(path, shard):
+            continue
+        start = shard * shardSize
+        with EmbeddingWriter(shardPath(path, shard) + ".emb", embedder.dim, model=embedder.modelId) as writer:
+            for rowIds, vectors in embedder.stream(texts[start:start + shardSize], maxTokens):
+                writer.append(vectors, np.asarray(rowIds) + start)
+            rows = writer.rows
+        with open(shardPath(path, shard) + ".done", "w") as f:
+            json.dump({"rows": rows}, f)
+        embedded += 1
+    return embedded
+
+
+def merge(path, chunkSize=100000):
+    """Concatenate the shards of path into the embedding store path. Return False while some shards are not done."""
+    with open(os.path.join(shardFolder(path), "job.json")) as f:
+        job = json.load(f)
+    shards = range(shardCount(job["rows"], job["shardSize"]))
+    if not all(isDone(path, shard) for shard in shards):
+        return False
+    tmp = path + ".tmp" + str(os.getpid())
+    writer = None
+    for shard in tqdm(shards):
+        store = EmbeddingStore(shardPath(path, shard) + ".emb")
+        if writer is None:
+            writer = EmbeddingWriter(tmp, store.dim, store.dtype, model=job["model"])
+        for start in range(0, len(store), chunkSize):
+            writer.append(store.vectors[start:start + chunkSize], store.ids[start:start + chunkSize])
+    writer.close()
+    os.replace(tmp + ".ids", path + ".ids")
+    os.replace(tmp, path)
+    return True
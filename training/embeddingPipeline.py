@@ -0,0 +1,179 @@
+"""
+Streaming BERT embedding shared by the embedding scripts: tokenization -> batching -> model -> writer.
+
+Each stage is a generator consuming the previous one, so only one window of token ids, one padded batch and one
+batch of outputs are alive at a time: peak memory depends on the batch size, not on the size of the corpus.
+    - tokenizeStream calls the batched fast tokenizer on chunks of texts (truncation done by the tokenizer).
+    - bucketStream sorts the rows of a window by length and cuts batches under a token budget
+      (batch size x padded length), so short link texts run in large batches and long documents in small ones.
+      Batches are padded by the tokenizer, which returns the attention masks.
+    - embedStream runs the model with the attention mask and mean-pools the last hidden states over the real tokens
+      only, so padding neither changes the vectors nor depends on the other rows of the batch.
+    - orderedStream puts the outputs back in the original row order before they reach the writer.
+BertEmbedder bundles the tokenizer, the model and these stages. It runs on the cpu by default (our batch nodes have
+no gpu), with a configurable number of intra-op threads and an optional dynamic int8 quantization of the Linear
+layers; benchmarkEmbedder.py measures the throughput and the drift of the quantized model against fp32.
+Given an EmbeddingCache (see embeddingCache.py), only the texts missing from the cache go through the model.
+"""
+import numpy as np
+import torch
+from transformers import BertTokenizerFast, BertModel
+from tqdm import tqdm
+from training.embeddingStore import EmbeddingWriter
+
+
+def tokenizeStream(texts, tokenizer, maxLength, chunkSize=1024):
+    """Yield (rowId, tokenIds) for every text, tokenized by chunks of chunkSize texts and cut to maxLength tokens."""
+    chunk = []
+    start = 0
+    for text in texts:
+        chunk += [str(text)]
+        if len(chunk) == chunkSize:
+            yield from tokenizeChunk(chunk, start, tokenizer, maxLength)
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield from tokenizeChunk(chunk, start, tokenizer, maxLength)
+
+
+def tokenizeChunk(chunk, start, tokenizer, maxLength):
+    tokenIds = tokenizer(chunk, truncation=True, max_length=maxLength)["input_ids"]
+    for i, ids in enumerate(tokenIds):
+        yield start + i, ids
+
+
+def padBatch(batch, tokenizer):
+    """Padded input_ids and attention_mask tensors of a list of token id lists."""
+    return tokenizer.pad({"input_ids": batch}, return_tensors="pt")
+
+
+def bucketStream(tokenized, tokenizer, maxTokens, maxBatchSize=None, window=10000):
+    """
+    Yield (rowIds, padded batch) batches of rows of similar lengths, with at most maxTokens padded tokens per batch.
+    Rows are sorted by length inside windows of `window` rows, so at most one window of token ids is in memory.
+    """
+    rows = []
+    for item in tokenized:
+        rows += [item]
+        if len(rows) == window:
+            yield from bucketWindow(rows, tokenizer, maxTokens, maxBatchSize)
+            rows = []
+    if rows:
+        yield from bucketWindow(rows, tokenizer, maxTokens, maxBatchSize)
+
+
+def bucketWindow(rows, tokenizer, maxTokens, maxBatchSize):
+    rows = sorted(rows, key=lambda r: len(r[1]))
+    rowIds, batch, width = [], [], 1
+    for rowId, tokenIds in rows:
+        newWidth = max(width, len(tokenIds))
+        full = maxBatchSize is not None and len(batch) == maxBatchSize
+        if batch and (full or (len(batch) + 1) * newWidth > maxTokens):
+            yield rowIds, padBatch(batch, tokenizer)
+            rowIds, batch, newWidth = [], [], max(1, len(tokenIds))
+        rowIds += [rowId]
+        batch += [tokenIds]
+        width = newWidth
+    if batch:
+        yield rowIds, padBatch(batch, tokenizer)
+
+
+def orderedStream(embedded, firstRow=0):
+    """Buffer out-of-order (rowIds, outputs) batches and yield them back as runs of consecutive rows."""
+    pending = {}
+    nextRow = firstRow
+    for rowIds, outputs in embedded:
+        for rowId, vector in zip(rowIds, outputs):
+            pending[rowId] = vector
+        run = []
+        while nextRow in pending:
+            run += [nextRow]
+            nextRow += 1
+        if run:
+            yield run, np.stack([pending.pop(r) for r in run])
+    if pending:
+        raise ValueError("rows " + str(sorted(pending)[:10]) + " were embedded but some rows before them were not")
+
+
+def meanPool(hidden, mask):
+    """Mean of the hidden states over the positions where mask is 1."""
+    mask = mask.unsqueeze(-1).to(hidden.dtype)
+    return torch.sum(hidden * mask, dim=1) / torch.clamp(torch.sum(mask, dim=1), min=1.)
+
+
+def embedStream(batches, model, device):
+    """Yield (rowIds, embeddings) with the masked mean of the last hidden states of each batch."""
+    for rowIds, batch in batches:
+        inputIds = batch["input_ids"].to(device)
+        mask = batch["attention_mask"].to(device)
+        with torch.no_grad():
+            hidden = model(input_ids=inputIds, attention_mask=mask)[0]
+            outputs = meanPool(hidden, mask).float().cpu().numpy()
+        yield rowIds, outputs
+
+
+def writeStream(embedded, writer, total=None):
+    """Drain the pipeline into the writer, return the number of rows written."""
+    written = 0
+    for rowIds, outputs in tqdm(embedded, total=total):
+        writer.append(outputs, rowIds)
+        written += len(rowIds)
+    return written
+
+
+class BertEmbedder():
+    """
+    Mean-pooled BERT embedding of texts, computed with the streaming stages above.
+    device: "cpu" or a torch cuda device. threads: number of intra-op threads of torch (None keeps torch's default).
+    quantize: replace the Linear layers by dynamically quantized int8 ones (cpu only).
+    cache: an optional EmbeddingCache, looked up before running the model.
+    """
+    def __init__(self, modelName="bert-base-uncased", device="cpu", threads=None, quantize=False, cache=None):
+        if quantize and device != "cpu":
+            raise ValueError("dynamic int8 quantization only runs on the cpu, got device " + str(device))
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.modelName = modelName
+        self.device = device
+        self.quantize = quantize
+        self.cache = cache
+        # everything the vectors depend on: the cache key of a text is built from it
+        self.modelId = modelName + ":masked-mean" + (":int8" if quantize else "")
+        self.tokenizer = BertTokenizerFast.from_pretrained(modelName)
+        self.model = BertModel.from_pretrained(modelName)
+        self.model.eval()  # switch to eval mode (remove things like dropout)
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.to(device)
+        # Note: Bert max input sequence is 512
+        self.maxLength = min(self.tokenizer.model_max_length, self.model.config.max_position_embeddings)
+        self.dim = self.model.config.hidden_size
+
+    def stream(self, texts, maxTokens=8192, window=10000):
+        """(rowIds, embeddings) runs in the order of texts."""
+        if self.cache is not None:
+            return self.cache.stream(texts, lambda missing: self.encodeUncached(missing, maxTokens), self.modelId, window)
+        return self.streamUncached(texts, maxTokens, window)
+
+    def streamUncached(self, texts, maxTokens=8192, window=10000):
+        tokens = tokenizeStream(texts, self.tokenizer, self.maxLength)
+        batches = bucketStream(tokens, self.tokenizer, maxTokens, window=window)
+        return orderedStream(embedStream(batches, self.model, self.device))
+
+    def embedToStore(self, texts, path, maxTokens=8192):
+        """Append the embedding of every text to a new embedding store at path."""
+        with EmbeddingWriter(path, self.dim, model=self.modelName) as writer:
+            return writeStream(self.stream(texts, maxTokens), writer)
+
+    def encode(self, texts, maxTokens=8192):
+        """The (len(texts),dim) embedding matrix, kept in memory: for small sets of texts."""
+        outputs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for rowIds, vectors in self.stream(texts, maxTokens):
+            outputs[rowIds] = vectors
+        return outputs
+
+    def encodeUncached(self, texts, maxTokens=8192):
+        outputs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for rowIds, vectors in self.streamUncached(texts, maxTokens):
+            outputs[rowIds] = vectors
+        return outputs
@@ -0,0 +1,129 @@
+"""
+Append-only binary store for embedding matrices, replacing the DataFrame.to_csv output of the embedding scripts.
+
+A store is two files:
+    <path>      a header of headerSize bytes (magic + json: dim, dtype, model name, row count) followed by the rows,
+                each one dim values of dtype (float32 or float16), in the order they were appended.
+    <path>.ids  the int64 row id of every row (by default its position in the input data).
+EmbeddingWriter appends rows while they are computed, EmbeddingStore opens the rows as a numpy.memmap.
+The number of rows is recovered from the file sizes, so a store cut by an interrupted run is still readable
+(and can be appended to again).
+"""
+import os
+import json
+import struct
+import numpy as np
+
+magic = b"TLEMB\x00\x01\x00"
+headerSize = 1024
+
+
+def readHeader(path):
+    with open(path, "rb") as f:
+        head = f.read(headerSize)
+    if head[:len(magic)] != magic:
+        raise ValueError(path + " is not an embedding store")
+    length = struct.unpack("<I", head[len(magic):len(magic) + 4])[0]
+    return json.loads(head[len(magic) + 4:len(magic) + 4 + length].decode("utf-8"))
+
+
+def writeHeader(f, header):
+    payload = json.dumps(header).encode("utf-8")
+    if len(magic) + 4 + len(payload) > headerSize:
+        raise ValueError("embedding store header too long: " + str(header))
+    f.seek(0)
+    f.write((magic + struct.pack("<I", len(payload)) + payload).ljust(headerSize, b" "))
+
+
+def storedRows(path, header):
+    """Number of complete rows, taking the smallest of the matrix and id files (both may be cut by a crash)."""
+    rowBytes = header["dim"] * np.dtype(header["dtype"]).itemsize
+    rows = (os.path.getsize(path) - headerSize) // rowBytes
+    if os.path.exists(path + ".ids"):
+        rows = min(rows, os.path.getsize(path + ".ids") // 8)
+    else:
+        rows = 0
+    return int(rows)
+
+
+class EmbeddingWriter():
+    """Appends embeddings to a store; with append=True an existing store is continued after its last complete row."""
+    def __init__(self, path, dim, dtype="float32", model="", append=False):
+        self.path = path
+        if append and os.path.exists(path):
+            self.header = readHeader(path)
+            if self.header["dim"] != dim or np.dtype(self.header["dtype"]) != np.dtype(dtype):
+                raise ValueError("cannot append " + str(dim) + " " + str(dtype) + " rows to " + path)
+            self.rows = storedRows(path, self.header)
+            rowBytes = dim * np.dtype(dtype).itemsize
+            self.vectors = open(path, "r+b")
+            self.vectors.truncate(headerSize + self.rows * rowBytes)
+            self.vectors.seek(0, os.SEEK_END)
+            self.ids = open(path + ".ids", "r+b")
+            self.ids.truncate(self.rows * 8)
+            self.ids.seek(0, os.SEEK_END)
+        else:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.header = {"dim": int(dim), "dtype": np.dtype(dtype).name, "model": model, "rows": 0}
+            self.rows = 0
+            self.vectors = open(path, "w+b")
+            writeHeader(self.vectors, self.header)
+            self.ids = open(path + ".ids", "w+b")
+        self.dtype = np.dtype(self.header["dtype"])
+
+    def append(self, vectors, ids=None):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        if vectors.ndim != 2 or vectors.shape[1] != self.header["dim"]:
+            raise ValueError("expected rows of dimension " + str(self.header["dim"]) + ", got " + str(vectors.shape))
+        if ids is None:
+            ids = np.arange(self.rows, self.rows + vectors.shape[0])
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self.vectors.write(vectors.tobytes())
+        self.ids.write(ids.tobytes())
+        self.rows += vectors.shape[0]
+
+    def flush(self):
+        self.header["rows"] = self.rows
+        position = self.vectors.tell()
+        writeHeader(self.vectors, self.header)
+        self.vectors.seek(position)
+        self.vectors.flush()
+        self.ids.flush()
+
+    def close(self):
+        self.flush()
+        self.vectors.close()
+        self.ids.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EmbeddingStore():
+    """Read side of a store: vectors is a (rows,dim) numpy.memmap, ids the matching (rows,) memmap of row ids."""
+    def __init__(self, path):
+        self.path = path
+        header = readHeader(path)
+        self.dim = header["dim"]
+        self.dtype = np.dtype(header["dtype"])
+        self.model = header["model"]
+        self.rows = storedRows(path, header)
+        if self.rows > 0:
+            self.vectors = np.memmap(path, dtype=self.dtype, mode="r", offset=headerSize, shape=(self.rows, self.dim))
+            self.ids = np.memmap(path + ".ids", dtype=np.int64, mode="r", shape=(self.rows,))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=self.dtype)
+            self.ids = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.rows
+
+    def inRowOrder(self):
+        """The vectors ordered by row id (a copy, only needed when rows were not appended in order)."""
+        order = np.argsort(self.ids, kind="stable")
+        return self.vectors[order]
@@ -0,0 +1,103 @@
+"""
+Exact k nearest neighbor search with blocked matrix products.
+
+The distances between a block of queries and a block of documents come out of one BLAS matmul:
+    squared L2: |q|^2 - 2 q.d + |d|^2, with the norms of the documents computed once,
+    cosine: 1 - q.d on rows normalized once.
+The k best of each block are selected with argpartition and merged with the best of the previous blocks, so the
+memory stays bounded by queryBlock x docBlock distances whatever the number of documents. The query blocks run on a
+thread pool (numpy releases the GIL in the matmul and the partitions).
+ExactKnn.query has the (distances, ids) interface of cKDTree.query, so metrics.knn_accuracy accepts it.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+metrics = ["l2", "cosine"]
+
+
+def squaredDistances(X, C, cNorms=None):
+    """(len(X),len(C)) squared L2 distances, with one matmul (cNorms: the precomputed squared norms of C)."""
+    if cNorms is None:
+        cNorms = np.sum(np.square(C), axis=1)
+    return np.maximum(np.sum(np.square(X), axis=1)[:, None] - 2 * (X @ C.T) + cNorms[None, :], 0)
+
+
+def gatheredDistances(Q, D, ids, dNorms=None):
+    """(len(Q),ids.shape[1]) squared L2 distances of every query Q[i] to its own documents D[ids[i]]."""
+    if dNorms is None:
+        dNorms = np.sum(np.square(D), axis=1)
+    return np.maximum(np.sum(np.square(Q), axis=1)[:, None] - 2 * np.matmul(D[ids], Q[:, :, None])[:, :, 0]
+                      + dNorms[ids], 0)
+
+
+def normalizeRows(X):
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.where(norms > 0, norms, 1)
+
+
+def mergeTop(dist, ids, k):
+    """The k smallest distances of every row (unsorted) and their ids."""
+    if dist.shape[1] <= k:
+        return dist, ids
+    keep = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(dist, keep, axis=1), np.take_along_axis(ids, keep, axis=1)
+
+
+class ExactKnn():
+    def __init__(self, data, metric="l2", dtype=np.float32):
+        if metric not in metrics:
+            raise ValueError("unknown metric " + str(metric) + ", expected one of " + str(metrics))
+        self.metric = metric
+        self.data = np.asarray(data, dtype=dtype)
+        if metric == "cosine":
+            self.data = normalizeRows(self.data)
+        self.norms = np.sum(np.square(self.data), axis=1)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def distances(self, Q, start=0, end=None):
+        """Distances of the queries Q to the documents start:end (squared L2, or 1-cosine)."""
+        D = self.data[start:end]
+        if self.metric == "cosine":
+            return 1 - Q @ D.T
+        return squaredDistances(Q, D, self.norms[start:end])
+
+    def queryBlock(self, Q, k, docBlockSize):
+        Q = np.asarray(Q, dtype=self.data.dtype)
+        if self.metric == "cosine":
+            Q = normalizeRows(Q)
+        bestDist = np.full((Q.shape[0], k), np.inf, dtype=self.data.dtype)
+        bestIds = np.full((Q.shape[0], k), len(self), dtype=np.int64)
+        for start in range(0, len(self), docBlockSize):
+            dist = self.distances(Q, start, start + docBlockSize)
+            dist, ids = mergeTop(dist, np.broadcast_to(np.arange(start, start + dist.shape[1]), dist.shape), k)
+            bestDist, bestIds = mergeTop(np.concatenate([bestDist, dist], axis=1),
+                                         np.concatenate([bestIds, ids], axis=1), k)
+        order = np.lexsort((bestIds, bestDist), axis=1)
+        return np.take_along_axis(bestDist, order, axis=1), np.take_along_axis(bestIds, order, axis=1)
+
+    def query(self, X, k=1, workers=-1, blockSize=256, docBlockSize=16384):
+        """
+        (distances, ids) of the k nearest documents of every row of X, closest first (ties by id), like
+        cKDTree.query: L2 distances (or 1-cosine), missing neighbors have an infinite distance and the id len(self).
+        Blocks of blockSize queries run on workers threads (-1: every core).
+        """
+        X = np.asarray(X)
+        squeeze = X.ndim == 1
+        X = np.atleast_2d(X)
+        if workers is None or workers < 1:
+            workers = os.cpu_count()
+        blocks = range(0, X.shape[0], blockSize)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda b: self.queryBlock(X[b:b + blockSize], k, docBlockSize), blocks))
+        distances = np.concatenate([d for d, _ in results]) if results else np.empty((0, k))
+        ids = np.concatenate([i for _, i in results]) if results else np.empty((0, k), dtype=np.int64)
+        if self.metric == "l2":
+            distances = np.sqrt(distances)
+        if k == 1:
+            distances, ids = distances[:, 0], ids[:, 0]
+        if squeeze:
+            distances, ids = distances[0], ids[0]
+        return distances, ids
@@ -8,25 +8,23 @@ For ease of implementation, each training mechanism is abstracted in a separate
         training and testing context dataset, as well as the target dataset(always the same both for testing and training)...
 """
 import os
+import multiprocessing
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from training import metrics
+from training import dataCache
 from training import SimpleModels as sm
 from matplotlib.cm import  get_cmap
 from joblib import dump, load
 
 restrictSize = 1000
-#Import data
-data = pd.read_csv(os.path.join("data3","exact_hits.csv"),sep="\t",nrows=restrictSize)
-data_doc2vec_target = pd.read_csv(os.path.join("data3","doc2vec_target_context.csv"),nrows=restrictSize)
-doc2vec_target = data_doc2vec_target.values[:,1:]
-data_doc2vec_link = pd.read_csv(os.path.join("data3","doc2vec_link_context.csv"),nrows=restrictSize)
-doc2vec_link = data_doc2vec_link.values[:,1:]
-data_bert_target = pd.read_csv(os.path.join("data3","bert_target_context.csv"),nrows=restrictSize)
-bert_target = data_bert_target.values[:,1:]
-data_bert_link = pd.read_csv(os.path.join("data3","bert_link_context.csv"),nrows=restrictSize)
-bert_link = data_bert_link.values[:,1:]
+#Import data (through the binary cache of dataCache, the csv files are only parsed on their first use)
+data = dataCache.readHits(nrows=restrictSize)
+doc2vec_target = dataCache.readEmbedding(os.path.join("data3","doc2vec_target_context.csv"),nrows=restrictSize)
+doc2vec_link = dataCache.readEmbedding(os.path.join("data3","doc2vec_link_context.csv"),nrows=restrictSize)
+bert_target = dataCache.readEmbedding(os.path.join("data3","target_context.emb"),nrows=restrictSize) #written by secondEmbedding.py
+bert_link = dataCache.readEmbedding(os.path.join("data3","link_context.emb"),nrows=restrictSize)
 
 #let us first try to split the data randomly
 size = doc2vec_link.shape[0]
@@ -45,16 +43,18 @@ DTest = doc2vec_target[testIdx]
 
 
 #Create the knn filter datastrucutre (includes a word to doc dictionnary)
-filterKnn = metrics.FilteredKnn(data)  #the filter should contain test and training example.
+#The sharded build needs fork: with spawn the worker processes would re-execute this script.
+indexWorkers = os.cpu_count() if "fork" in multiprocessing.get_all_start_methods() else 1
+#The saved index is found by the size and mtime of exact_hits.csv and the number of rows, without hashing the texts.
+hitsKey = str(dataCache.sourceStamp(os.path.join("data3","exact_hits.csv")))+"/nrows="+str(restrictSize)
+filterKnn = metrics.FilteredKnn(data,cacheDir=os.path.join("data3","index"),workers=indexWorkers,cacheKey=hitsKey)  #the filter should contain test and training example.
 #First let us analyze the baselines
 
 T = [1,5,10,25,50,100,200,300]
 K = [1,5,10,25,50,100,200]
 L = data.values[:,0]
-score_count_search = np.zeros((len(K),len(T)))
-for idxk,k in enumerate(K):
-    for idxt,t in enumerate(T):
-        score_count_search[idxk,idxt] = filterKnn.raw_tf_accuracy(t,k,L)
+filterKnn.selectTop(max(T)) #one partial sort at the largest T serves every smaller T of the sweep
+score_count_search = filterKnn.raw_tf_accuracy_grid(T,K,L)
 cm = get_cmap("Accent")
 for idxk,k in enumerate(K):
     plt.plot(T,score_count_search[idxk,:],c=cm(idxk),label=str(k)+"-accuracy")
@@ -73,14 +73,14 @@ models = [
            sm.pcaModel(num_dim),
            sm.MLPRegression(4),
            sm.MLPRegression(5),
-           sm.gpRegression(),
+           sm.rffRegression(),
            sm.chain([sm.tsneModel,sm.MLPRegression],[num_dim,3]),
-           sm.chain([sm.tsneModel,sm.gpRegression],[num_dim,None]),
+           sm.chain([sm.tsneModel,sm.rffRegression],[num_dim,None]),
            sm.chain([sm.ccaModel,sm.MLPRegression],[num_dim,3]),
-           sm.chain([sm.ccaModel,sm.gpRegression],[num_dim,None]),
+           sm.chain([sm.ccaModel,sm.rffRegression],[num_dim,None]),
            sm.chain([sm.pcaModel,sm.MLPRegression],[num_dim,3]),
-           sm.chain([sm.pcaModel,sm.gpRegression],[num_dim,None]),
-           sm.chain([sm.gpRegression,sm.MLPRegression],[None,3])
+           sm.chain([sm.pcaModel,sm.rffRegression],[num_dim,None]),
+           sm.chain([sm.rffRegression,sm.MLPRegression],[None,3])
 ]
 num_dim = np.arange(2,100,10)
 def exploreModelperformance(m,filterKnn,L,Qtrain,Dtrain,Qtest,Dtest):
@@ -94,9 +94,7 @@ def exploreModelperformance(m,filterKnn,L,Qtrain,Dtrain,Qtest,Dtest):
     ED[trainIdx] = EDtrain
     ED[testIdx] = EDtest
 
-    for idxk,k in enumerate(K):
-        for idxt,t in enumerate(T):
-            scores[idxk,idxt] = filterKnn.measure_knn_acc(t,k,L,EQtest,ED)
+    scores[:,:] = filterKnn.measure_knn_acc_grid(T,K,L,EQtest,ED) #all the (k,t) pairs in one pass
     cm = get_cmap("Accent")
     for idxk,k in enumerate(K):
         plt.plot(T,scores[idxk,:],c=cm(idxk),label=str(k)+"-accuracy")
@@ -116,7 +114,7 @@ def compareModel(models,filterKnn,L,Qtrain,Dtrain,Qtest,Dtest):
         ED = np.zeros((doc2vec_target.shape[0],EDtrain.shape[1]))
         ED[trainIdx] = EDtrain
         ED[testIdx] = EDtest
-        scores += [filterKnn.measure_knn_acc(t,k,L,EQtest,ED)]
+        scores += [filterKnn.measure_knn_acc(T,k,L,EQtest,ED)]
         #Save model parameters
         model = m.getmodel()
         if type(model)==list:
@@ -131,7 +129,7 @@ def compareModel(models,filterKnn,L,Qtrain,Dtrain,Qtest,Dtest):
         pd.DataFrame(scores).to_csv("scores.csv") #progressive save
     pd.DataFrame(scores).to_csv("scores.csv")
     """Let us display scores as a bar plot"""
-    scores +=[filterKnn.raw_tf_accuracy(t,k,L)]
+    scores +=[filterKnn.raw_tf_accuracy(T,k,L)]
     labels = [str(m) for m in models]+["raw_count"]
     cm = get_cmap("Accent")
     colors = [cm(idx) for idx in range(len(scores))]
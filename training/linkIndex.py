@@ -0,0 +1,242 @@
+"""
+Inverted index from link texts to the documents that contain them.
+
+FilteredKnn needs, for every link text L, the documents d in which L appears together with the count of L in d.
+Scanning every document for every link is O(links x docs x doc length), so instead we build the postings in a single
+pass over the documents (optionally sharded over a process pool):
+    1) Link texts made of a single token (e.g. "objectify") are looked up in the token counts of each document.
+    2) Link texts that do not tokenize cleanly (e.g. "lxml.html", "qgsprocessingalgorithm.h:223") are matched with an
+       Aho-Corasick automaton, so that all of them are counted with one scan of the document.
+The postings are stored CSR-style: the postings of term t are docIds[indptr[t]:indptr[t+1]] and counts[...].
+On disk an index is a directory with one .npy file per array and a json term dictionary. Arrays are opened as
+numpy.memmap, so loading is nearly free and processes that load the same index share the pages.
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
+import numpy as np
+from tqdm import tqdm
+
+tokenPattern = re.compile(r"\w+")
+formatVersion = 1
+
+
+def isCleanToken(word):
+    """True if the link text is exactly one token of the document tokenizer."""
+    return tokenPattern.fullmatch(word) is not None
+
+
+class AhoCorasick():
+    """Multi-pattern string matcher: counts the occurrences of every pattern with a single pass over a text."""
+    def __init__(self, patterns):
+        self.lengths = [len(p) for p in patterns]
+        self.goto = [{}]  # one dict per trie node: char -> child node
+        self.fail = [0]
+        self.out = [[]]  # pattern ids ending at this node (including those reached through the fail links)
+        for pid, p in enumerate(patterns):
+            node = 0
+            for c in p:
+                nxt = self.goto[node].get(c)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][c] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(pid)
+        # breadth first construction of the fail links
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for c, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(c, 0)
+                self.fail[child] = f if f != child else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def count(self, text):
+        """Return {patternId: count} with the same semantic as str.count (non-overlapping, left to right)."""
+        counts = {}
+        lastEnd = {}
+        goto, fail, out, lengths = self.goto, self.fail, self.out, self.lengths
+        node = 0
+        for i, c in enumerate(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node]:
+                for pid in out[node]:
+                    if i + 1 - lengths[pid] >= lastEnd.get(pid, 0):
+                        counts[pid] = counts.get(pid, 0) + 1
+                        lastEnd[pid] = i + 1
+        return counts
+
+
+class ShardCounter():
+    """Counts the link texts over a shard of the documents, producing the (term, doc, count) triplets of its postings."""
+    def __init__(self, terms):
+        self.tokenTerms = {}
+        self.phraseTerms = []
+        for tid, t in enumerate(terms):
+            if isCleanToken(t):
+                self.tokenTerms[t] = tid
+            else:
+                self.phraseTerms += [tid]
+        self.matcher = AhoCorasick([terms[tid] for tid in self.phraseTerms])
+
+    def count(self, docs, offset, display=False):
+        termCol, docCol, countCol = [], [], []
+        docs = enumerate(docs, offset)
+        if display:
+            docs = tqdm(docs)
+        for idxDoc, doc in docs:
+            if not isinstance(doc, str):
+                continue
+            found = {}
+            for tok, c in Counter(tokenPattern.findall(doc)).items():
+                tid = self.tokenTerms.get(tok)
+                if tid is not None:
+                    found[tid] = c
+            for pid, c in self.matcher.count(doc).items():
+                found[self.phraseTerms[pid]] = c
+            for tid, c in found.items():
+                termCol += [tid]
+                docCol += [idxDoc]
+                countCol += [c]
+        return [np.asarray(col, dtype=np.int64) for col in [termCol, docCol, countCol]]
+
+
+workerCounter = {}  # ShardCounter used by the worker processes: inherited from the parent with fork, else initShardWorker
+
+
+def initShardWorker(terms):
+    workerCounter["counter"] = ShardCounter(terms)
+
+
+def countShardInWorker(docs, offset):
+    return workerCounter["counter"].count(docs, offset)
+
+
+class LinkIndex():
+    """Term -> postings (docId, count) for a fixed vocabulary of link texts."""
+    def __init__(self, terms, indptr, docIds, counts, nDocs):
+        self.terms = terms
+        self.termToId = {t: i for i, t in enumerate(terms)}
+        self.indptr = indptr
+        self.docIds = docIds
+        self.counts = counts
+        self.nDocs = nDocs
+
+    @classmethod
+    def build(cls, links, docs, display=True, workers=1, shardSize=None):
+        """
+        Index the link texts over the documents. With workers>1 the documents are split into contiguous shards that
+        are counted by a process pool, the partial postings are then merged: the result is the same as a serial build.
+        """
+        terms = list(dict.fromkeys(str(l) for l in links if str(l) != ""))
+        nDocs = len(docs)
+        if workers <= 1:
+            termCol, docCol, countCol = ShardCounter(terms).count(docs, 0, display)
+            return cls.fromTriplets(terms, termCol, docCol, countCol, nDocs)
+        if shardSize is None:
+            shardSize = max(1, -(-nDocs // (4 * workers)))  # a few shards per worker to balance the load
+        context = None
+        initializer, initargs = initShardWorker, (terms,)
+        if "fork" in multiprocessing.get_all_start_methods():
+            #the counter (trie and token dict) is built once here and inherited copy-on-write by the forked workers,
+            #instead of one copy per worker
+            context = multiprocessing.get_context("fork")
+            workerCounter["counter"] = ShardCounter(terms)
+            initializer, initargs = None, ()
+        parts = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=initializer, initargs=initargs) as pool:
+            futures = [pool.submit(countShardInWorker, list(docs[start:start + shardSize]), start)
+                       for start in range(0, nDocs, shardSize)]
+            done = as_completed(futures)
+            if display:
+                done = tqdm(done, total=len(futures))
+            for f in done:
+                parts += [f.result()]
+        workerCounter.clear()
+        termCol, docCol, countCol = [np.concatenate([p[i] for p in parts] + [np.zeros(0, np.int64)]) for i in range(3)]
+        return cls.fromTriplets(terms, termCol, docCol, countCol, nDocs)
+
+    @classmethod
+    def fromTriplets(cls, terms, termCol, docCol, countCol, nDocs):
+        termCol = np.asarray(termCol, dtype=np.int64)
+        docCol = np.asarray(docCol, dtype=np.int64)
+        countCol = np.asarray(countCol, dtype=np.int64)
+        order = np.lexsort((docCol, termCol))
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(termCol, minlength=len(terms)), out=indptr[1:])
+        return cls(terms, indptr, docCol[order].astype(np.int32), countCol[order].astype(np.int32), nDocs)
+
+    def postings(self, word):
+        """Documents containing word and the number of occurrences in each, sorted by document id."""
+        tid = self.termToId.get(str(word))
+        if tid is None:
+            return self.docIds[:0], self.counts[:0]
+        start, end = self.indptr[tid], self.indptr[tid + 1]
+        return self.docIds[start:end], self.counts[start:end]
+
+    def save(self, path):
+        """Write the index into the directory path (replaced atomically if it already exists)."""
+        tmp = path + ".tmp" + str(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, "indptr.npy"), np.asarray(self.indptr))
+        np.save(os.path.join(tmp, "docIds.npy"), np.asarray(self.docIds))
+        np.save(os.path.join(tmp, "counts.npy"), np.asarray(self.counts))
+        with open(os.path.join(tmp, "terms.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": formatVersion, "nDocs": int(self.nDocs), "terms": self.terms}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "terms.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["version"] != formatVersion:
+            raise ValueError("index at " + path + " has format version " + str(meta["version"]))
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in ["indptr", "docIds", "counts"]]
+        return cls(meta["terms"], *arrays, meta["nDocs"])
+
+    @classmethod
+    def cached(cls, links, docs, cacheDir, display=True, workers=1, key=None):
+        """
+        Load the index of (links, docs) from cacheDir, building and saving it first if the data is new.
+        key identifies the data, e.g. the size and mtime of its source file (see dataCache.sourceStamp): the index is
+        then found without reading links and docs. By default the key is a hash of their content (see dataKey).
+        """
+        if key is None:
+            key = dataKey(links, docs)
+        else:
+            key = hashlib.sha1(("linkIndex" + str(formatVersion) + "\x00" + str(key)).encode()).hexdigest()[:16]
+        path = os.path.join(cacheDir, "linkIndex-" + key)
+        if os.path.exists(os.path.join(path, "terms.json")):
+            return cls.load(path)
+        os.makedirs(cacheDir, exist_ok=True)
+        cls.build(links, docs, display, workers).save(path)
+        return cls.load(path)
+
+
+def dataKey(links, docs):
+    """Hash of the input of LinkIndex.build, used to invalidate the saved indexes when the data changes."""
+    h = hashlib.sha1(("linkIndex" + str(formatVersion)).encode())
+    for column in [links, docs]:
+        h.update(b"\x00column")
+        for v in column:
+            h.update(b"\x00" + str(v).encode("utf-8", "surrogatepass"))
+    return h.hexdigest()[:16]
@@ -13,45 +13,170 @@ In this document I provide multiple metrics to evaluate how well a query set emb
     2 steps, for each query q of embedding Eq:
         1) We first select the T documents {d} with most frequency of L in d
         2) We compute the distance from Eq to filtered documents
+
+2) Knn accuracy (knn_accuracy):
+    The i-th query of X should retrieve the i-th document of Y among its k nearest neighbors (L2), for several k.
 """
 from tqdm import tqdm
-import heapq
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from training.exactKnn import ExactKnn, gatheredDistances
+from training.linkIndex import LinkIndex
 class FilteredKnn():
-    def __init__(self,data):
-        self.wordToDoc = {} #For each link: a heap containing elements like (frequency,docIDX)
-        for idx,word in tqdm(enumerate(data.values[:,0])): #1000 element: 0.2 sc
-            word=str(word)
-            self.wordToDoc[word] = (idx,[])
-            for idxDoc,target_doc in enumerate(data.values[:,2]):
-                count = target_doc.count(word)
-                if count>0:
-                    heapq.heappush(self.wordToDoc[word][1],(count,idxDoc,idx))
+    def __init__(self,data,cacheDir=None,workers=1,cacheKey=None):
+        #Inverted index link text -> (docIDX,count), built in one pass over the documents (see linkIndex.py)
+        #With a cacheDir the index is saved there and memory-mapped back by the next runs on the same data,
+        #found by cacheKey (e.g. the stamp of the source file) or else by a hash of the link and document columns.
+        #With workers>1 the documents are sharded over that many processes.
+        if cacheDir is None:
+            self.index = LinkIndex.build(data.values[:,0],data.values[:,2],workers=workers)
+        else:
+            self.index = LinkIndex.cached(data.values[:,0],data.values[:,2],cacheDir,workers=workers,key=cacheKey)
+        #link -> document counts, one row per link text of the index
+        self.counts = csr_matrix((self.index.counts,self.index.docIds,self.index.indptr),
+                                 shape=(len(self.index.terms),self.index.nDocs))
+        self.wordToLink = {} #For each link: the idx of the row it comes from, i.e. its target document
+        for idx,word in enumerate(data.values[:,0]):
+            self.wordToLink[str(word)] = idx
+        self.topT = 0
+    def selectTop(self,T,blockSize=2**22):
+        """
+        For every link, keep the (at most) T documents with the highest count, sorted by decreasing count then docIDX.
+        Rows with more than T documents are reduced with a row-wise argpartition over padded blocks of similar lengths,
+        then a single lexsort orders every kept element. The result serves topDocs for any T' <= T.
+        """
+        T = max(int(T),1)
+        indptr = np.asarray(self.counts.indptr,dtype=np.int64)
+        docs = np.asarray(self.counts.indices,dtype=np.int64)
+        lengths = np.diff(indptr)
+        rows = np.repeat(np.arange(lengths.shape[0]),lengths)
+        #unique key per row: decreasing count, ties broken by increasing docIDX
+        key = -np.asarray(self.counts.data,dtype=np.int64)*(self.counts.shape[1]+1)+docs
+        keep = np.ones(docs.shape[0],dtype=bool)
+        longRows = np.nonzero(lengths>T)[0]
+        longRows = longRows[np.argsort(lengths[longRows],kind="stable")]
+        b = 0
+        while b<longRows.shape[0]:
+            e = b+1
+            while e<longRows.shape[0] and (e+1-b)*lengths[longRows[e]]<=blockSize:
+                e += 1
+            block = longRows[b:e]
+            width = lengths[block[-1]]
+            pos = indptr[block][:,None]+np.arange(width)[None,:]
+            valid = pos<indptr[block+1][:,None]
+            padded = np.where(valid,key[np.minimum(pos,key.shape[0]-1)],np.iinfo(np.int64).max)
+            dropped = np.argpartition(padded,T-1,axis=1)[:,T:]
+            dropped = np.take_along_axis(pos,dropped,axis=1)[np.take_along_axis(valid,dropped,axis=1)]
+            keep[dropped] = False
+            b = e
+        order = np.lexsort((key[keep],rows[keep]))
+        self.topDocIds = docs[keep][order].astype(np.int32)
+        self.topIndptr = np.zeros(lengths.shape[0]+1,dtype=np.int64)
+        np.cumsum(np.minimum(lengths,T),out=self.topIndptr[1:])
+        self.topT = T
+    def topDocs(self,word,T):
+        """The T documents with most occurrences of word (fewer if word appears in less documents)."""
+        if T>self.topT:
+            self.selectTop(T)
+        row = self.index.termToId.get(str(word))
+        if row is None:
+            return self.topDocIds[:0]
+        start = self.topIndptr[row]
+        return self.topDocIds[start:min(start+T,self.topIndptr[row+1])]
+    def candidates(self,L,T):
+        """Padded (len(L),T) matrix of the topDocs of every link of L, with a validity mask for the padding."""
+        if T>self.topT:
+            self.selectTop(T)
+        rows = np.array([self.index.termToId.get(str(l),-1) for l in L],dtype=np.int64)
+        starts = np.where(rows>=0,self.topIndptr[rows],0)
+        lengths = np.where(rows>=0,np.minimum(self.topIndptr[rows+1]-starts,T),0)
+        valid = np.arange(T)[None,:]<lengths[:,None]
+        pos = np.minimum(starts[:,None]+np.arange(T)[None,:],max(self.topDocIds.shape[0]-1,0))
+        cand = np.where(valid,self.topDocIds[pos] if self.topDocIds.shape[0]>0 else 0,-1)
+        return cand,valid
+    def targets(self,L):
+        """Index of the document each link of L should retrieve."""
+        return np.array([self.wordToLink[str(l)] for l in L],dtype=np.int64)
+    def measure_knn_acc_grid(self,T,K,L,EQ,ED,blockSize=None):
+        """
+        k-accuracy of the filtered knn for every (k,t) of K x T, returned as a (len(K),len(T)) matrix.
+        The distances to the candidates are computed once at max(T), in blocks of queries;
+        for each t the rank of the target is then the number of closer candidates among the first t.
+        By default blockSize keeps the gathered (block,max(T),dim) candidate embeddings around 2**24 floats.
+        """
+        T = np.asarray(T,dtype=np.int64)
+        K = np.asarray(K,dtype=np.int64)
+        maxT = int(T.max())
+        ED = np.asarray(ED,dtype=np.float64)
+        EQ = np.asarray(EQ,dtype=np.float64)
+        if blockSize is None:
+            blockSize = max(1,2**24//(maxT*ED.shape[1]))
+        edNorms = np.sum(np.square(ED),axis=1)
+        hits = np.zeros((K.shape[0],T.shape[0]))
+        for b in range(0,EQ.shape[0],blockSize):
+            Eq = EQ[b:b+blockSize]
+            Lb = L[b:b+Eq.shape[0]] #L[idx] is the link of the query EQ[idx]
+            cand,valid = self.candidates(Lb,maxT)
+            target = self.targets(Lb)
+            distances = gatheredDistances(Eq,ED,np.maximum(cand,0),edNorms)
+            isTarget = (cand==target[:,None]) & valid
+            found = isTarget.any(axis=1)
+            targetPos = np.argmax(isTarget,axis=1)
+            targetDist = distances[np.arange(cand.shape[0]),targetPos]
+            #a candidate is ranked before the target if closer (or as close and earlier in the filter)
+            before = valid & ((distances<targetDist[:,None]) |
+                              ((distances==targetDist[:,None]) & (np.arange(maxT)[None,:]<targetPos[:,None])))
+            rankAtT = np.cumsum(before,axis=1)[:,T-1] #(queries,len(T))
+            inFilter = found[:,None] & (targetPos[:,None]<T[None,:])
+            hits += np.sum(inFilter[None,:,:] & (rankAtT[None,:,:]<K[:,None,None]),axis=1)
+        return hits/EQ.shape[0]
     def measure_knn_acc(self,T,k,L,EQ,ED):
-        score = 0.
-        for idx,Eq in enumerate(EQ):
-            word = str(L[idx])
-            filteredDocIdx = np.array([v[1] for v in self.wordToDoc[word][1][:T]])
-            distances = np.sum(np.square(Eq - ED[filteredDocIdx]),axis=1)
-            ranking = np.argsort(distances) #will fail because now distances has less element.... so we need to retrieve the real idx...
-            realRanking = filteredDocIdx[ranking] #retrieve the real ranking idx.
-            if self.wordToDoc[word][0] in realRanking[:k]:
-                score +=1.
-        return score/EQ.shape[0]
-    def raw_tf_accuracy(self,t,k,L,display=False):
-        score = 0.
+        return self.measure_knn_acc_grid([T],[k],L,EQ,ED)[0,0]
+    def raw_tf_accuracy_grid(self,T,K,L,display=False,blockSize=2**16):
+        """
+        k-accuracy of the raw count search for every (k,t) of K x T, returned as a (len(K),len(T)) matrix.
+        The position of the target in the frequency ordering of each link is computed once at max(T):
+        the target is retrieved at (k,t) iff its position is below min(k,t).
+        """
+        T = np.asarray(T,dtype=np.int64)
+        K = np.asarray(K,dtype=np.int64)
+        maxT = int(T.max())
+        positionCount = np.zeros(maxT,dtype=np.int64)
+        blocks = range(0,L.shape[0],blockSize)
         if display:
-            for idx,l in tqdm(enumerate(L)):
-                word = str(l)
-                filteredDocIdx = np.array([v[1] for v in self.wordToDoc[word][1][:t]])
-                linkIdx = self.wordToDoc[word][0]
-                if linkIdx in filteredDocIdx[:k]:
-                    score +=1.
-        else:
-            for idx,l in enumerate(L):
-                word = str(l)
-                filteredDocIdx = np.array([v[1] for v in self.wordToDoc[word][1][:t]])
-                linkIdx = self.wordToDoc[word][0]
-                if linkIdx in filteredDocIdx[:k]:
-                    score +=1.
-        return score/L.shape[0]
+            blocks = tqdm(blocks)
+        for b in blocks:
+            Lb = L[b:b+blockSize]
+            cand,valid = self.candidates(Lb,maxT)
+            isTarget = (cand==self.targets(Lb)[:,None]) & valid
+            found = isTarget.any(axis=1)
+            positionCount += np.bincount(np.argmax(isTarget,axis=1)[found],minlength=maxT)
+        retrievedBelow = np.concatenate([[0],np.cumsum(positionCount)]) #retrievedBelow[n]: links with the target in the first n
+        return retrievedBelow[np.minimum(K[:,None],T[None,:])]/L.shape[0]
+    def raw_tf_accuracy(self,t,k,L,display=False):
+        return self.raw_tf_accuracy_grid([t],[k],L,display)[0,0]
+
+
+def knn_accuracy(X,Y,K=(1,5,10,50),workers=-1):
+    """
+    k-accuracy of every k in K, and the mean reciprocal rank, of the query X[i] retrieving Y[i].
+    Y is the document embedding or an already built index of it (cKDTree, exactKnn.ExactKnn, annIndex.IvfPqIndex);
+    embeddings of more than 16 dimensions are searched by ExactKnn, where a KD-tree would scan everything anyway.
+    The tree is queried once at max(K) (over workers threads, -1: every core): the target is retrieved at k iff
+    its rank among the neighbors is below k. The MRR is truncated at max(K) (a target further away counts 0).
+    """
+    K = np.asarray(K,dtype=np.int64)
+    if hasattr(Y,"query"):
+        tree = Y
+    else:
+        tree = ExactKnn(Y) if np.shape(Y)[1]>16 else cKDTree(Y)
+    maxK = int(K.max())
+    _,neighbors = tree.query(X,maxK,workers=workers)
+    neighbors = np.reshape(neighbors,(-1,maxK))
+    isTarget = neighbors==np.arange(neighbors.shape[0])[:,None]
+    found = isTarget.any(axis=1)
+    rank = np.where(found,np.argmax(isTarget,axis=1),maxK)
+    scores = np.mean(rank[None,:]<K[:,None],axis=1)
+    mrr = np.mean(np.where(found,1/(rank+1),0))
+    return scores,mrr
@@ -8,25 +8,27 @@ We use huggingface's transformer labrary to easily retrieve Bert model in pytorc
 """
 
 import torch
-from transformers import BertTokenizer, BertModel
 import logging
-import pandas as pd
-import numpy as np
 import os
-from tqdm  import  tqdm
+import sys
+from training import dataCache
+from training.embeddingPipeline import BertEmbedder
+from training.embeddingCache import EmbeddingCache
+from training import embeddingJobs
 logging.basicConfig(level=logging.INFO)
 
-### Loading of BERT model
-#load pre-trained model tokenizer (vocabulary)
-tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-model = BertModel.from_pretrained('bert-base-uncased')      #load the model
-model.eval()     #switch to eval mode (remove things like dropout)
-model.to('cuda')    #Put the model on the gpu:
+### Loading of BERT model (fast tokenizer + model), see embeddingPipeline.py
+# On the gpu when there is one, otherwise on the cpu with every core (quantize=True trades a small drift for speed,
+# see benchmarkEmbedder.py)
+# The embeddings of the texts already seen (by any previous run) are read from the cache instead of recomputed.
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+cache = EmbeddingCache(os.path.join("data3","embeddings.sqlite"))
+embedder = BertEmbedder("bert-base-uncased",device=device,cache=cache)
 
 #Restrict for testing:
 restrictSize = 1000
 ###Loading of the Data:
-data = pd.read_csv("data3\exact_hits.csv",sep="\t",nrows=restrictSize)
+data = dataCache.readHits(nrows=restrictSize)
 print(data.columns)
 link_text_data = data.values[:restrictSize,0]
 link_context_data = data.values[:restrictSize,1]
@@ -39,62 +41,28 @@ for line in range(link_context_data.shape[0]):
     replac=replac.replace("<<LNK>>", str(context))
     link_context_data[line]=replac
 
-# Note: Bert max input sequence is 512 we can get it through:
-max_model_input_size = tokenizer.max_model_input_sizes['bert-base-uncased']
-def tokenize(data):
-    data_token=[]
-    for c in tqdm(data):# this step takes about 1 minutes of time.... tqdm is for progression bar
-        tok = tokenizer.tokenize(str(c))
-        data_token += [tok]
-    data_tokenID = []
-    for c in tqdm(data_token):
-        if len(c)>max_model_input_size: #Just cut....
-            c = c[:max_model_input_size]
-        tok_id = tokenizer.convert_tokens_to_ids(c)
-        data_tokenID += [tok_id]
-    return data_token,data_tokenID
-link_text_token,link_text_tokenID = tokenize(link_text_data)
-link_context_token,link_context_tokenID = tokenize(link_context_data)
-target_context_token,target_context_tokenID = tokenize(target_context_data)
-
-# Let us embed everything:
-# First we must pad the inputs so that we have a tensor (then we can use batched operation).
-
-# To accelerate embedding, we can use batches of input of similar sizes,
-# But we then loose the clear organisation of data, this can be circumvent using a dictionnary ==> not so easy to code...
-sizes = [len(c) for c in link_text_tokenID]
-unique_sizes = np.unique(sizes)
-sizeslink_context_tokenID = [len(c) for c in link_context_tokenID]
-unique_sizeslink_context_tokenID = np.unique(sizeslink_context_tokenID)
-sizestarget_context_tokenID = [len(c) for c in target_context_tokenID]
-unique_sizestarget_context_tokenID = np.unique(sizestarget_context_tokenID)
-
-pad_dim = max(unique_sizes)
-link_text_tokenID_padded = [c+[0 for _ in range(pad_dim-len(c))] for c in link_text_tokenID]
-pad_dim = max(sizeslink_context_tokenID)
-link_context_tokenID_padded = [c+[0 for _ in range(pad_dim-len(c))] for c in link_context_tokenID]
-pad_dim = max(sizestarget_context_tokenID)
-target_context_tokenID_padded = [c+[0 for _ in range(pad_dim-len(c))] for c in target_context_tokenID]
-
-# Now we proceed to BERT embedding
-toEmbed = [link_text_tokenID_padded,link_context_tokenID_padded,target_context_tokenID_padded]
-saveNames = [os.path.join("data3","link_text.csv"),os.path.join("data3","link_context.csv"),os.path.join("data3","target_context.csv")]
-mini_batch_sizes = [20,20,1]
-embeddings = []
+# Let us embed everything, as a stream (see embeddingPipeline.py): the texts are tokenized by chunks with the fast
+# tokenizer, grouped in batches of similar lengths under a token budget (batch size x padded length), embedded with
+# their attention mask (mean over the real tokens only), put back in the original row order
+# and appended to a binary embedding store. Only one window of rows is in memory at a time, whatever the number of rows.
+toEmbed = [link_text_data,link_context_data,target_context_data]
+saveNames = [os.path.join("data3","link_text.emb"),os.path.join("data3","link_context.emb"),os.path.join("data3","target_context.emb")]
+#Typically here we run out of memory on cuda with too large batches: the budget is lower for the long target documents,
+#as the attention cost grows with the square of the length.
+max_batch_tokens = [8192,8192,2048]
+# The rows are embedded by shards of shard_size rows (see embeddingJobs.py): a finished shard is never recomputed,
+# so an interrupted run resumes where it stopped (shards of other texts, from an older exact_hits.csv, are refused:
+# remove the .shards folder to start again). To split the work over several processes or machines, give each one
+# a disjoint range of shards: python secondEmbedding.py firstShard lastShard (lastShard excluded).
+# The shards are merged into the final store by the run that completes the last one.
+shard_size = 10000
+shards = None
+if len(sys.argv)>2:
+    shards = range(int(sys.argv[1]),int(sys.argv[2]))
 for idx,source in enumerate(toEmbed):
-    text_tensor = torch.tensor(source)
-    #Typically here we run out of memory on cuda if trying to do everything in a single batch, so need to separate in mini-batch
-    text_outputs = np.empty((0,768))
-    mini_batch_size = mini_batch_sizes[idx]
-    for j in tqdm(range(0,text_tensor.shape[0],mini_batch_size)): # takes about 40 minutes to run...
-        text_tensor_mb = text_tensor[j:min(j+mini_batch_size,text_tensor.shape[0])].to('cuda')
-        with torch.no_grad():
-            minibatch_outputs = torch.mean(model(text_tensor_mb)[0],dim=1).cpu()
-            text_outputs = np.concatenate([text_outputs,minibatch_outputs])
-    # save into a csv
-    save_link_text_outputs = pd.DataFrame(text_outputs)
-    save_link_text_outputs.to_csv(saveNames[idx])
-    embeddings += [save_link_text_outputs]
-
-
-
+    embeddingJobs.runShards(embedder,source,saveNames[idx],shard_size,shards,max_batch_tokens[idx])
+    print(cache.report())
+    if embeddingJobs.merge(saveNames[idx]):
+        print("merged",saveNames[idx])
+    else:
+        print("some shards of",saveNames[idx],"are not done yet")
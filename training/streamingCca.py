@@ -0,0 +1,99 @@
+"""
+Closed-form canonical correlation analysis, accumulated over blocks of rows.
+
+sklearn's CCA runs NIPALS, one iterative deflation per component. Here the sums of x, y, x.x^T, y.y^T and x.y^T are
+accumulated in float64 over blocks of rows (the inputs can be memory-mapped embeddings: O(d^2) memory whatever the
+number of rows), and every component is obtained at once from the generalized eigenproblem
+    Cxy Cyy^-1 Cyx wx = rho^2 Cxx wx
+solved by whitening with the Cholesky factors of the regularized auto-covariances (Cxx = Lx Lx^T) and one SVD of
+Lx^-1 Cxy Ly^-T = U S V^T: wx = Lx^-T U, wy = Ly^-T V, and S holds the canonical correlations, sorted.
+The components are nested: the first k columns are the solution with k components, so one fit serves every
+n_components, and score() evaluates every rank from a single projection.
+"""
+import numpy as np
+from scipy.linalg import cholesky, solve_triangular
+
+
+def blockMoments(X, Y, blockSize=65536):
+    """n, the means of X and Y, and the centered Cxx, Cyy, Cxy (float64, shifted by the first block means)."""
+    n = X.shape[0]
+    shiftX = np.mean(np.asarray(X[:blockSize], dtype=np.float64), axis=0)
+    shiftY = np.mean(np.asarray(Y[:blockSize], dtype=np.float64), axis=0)
+    sx, sy = np.zeros(X.shape[1]), np.zeros(Y.shape[1])
+    sxx = np.zeros((X.shape[1], X.shape[1]))
+    syy = np.zeros((Y.shape[1], Y.shape[1]))
+    sxy = np.zeros((X.shape[1], Y.shape[1]))
+    for b in range(0, n, blockSize):
+        x = np.asarray(X[b:b + blockSize], dtype=np.float64) - shiftX
+        y = np.asarray(Y[b:b + blockSize], dtype=np.float64) - shiftY
+        sx += np.sum(x, axis=0)
+        sy += np.sum(y, axis=0)
+        sxx += x.T @ x
+        syy += y.T @ y
+        sxy += x.T @ y
+    mx, my = sx / n, sy / n
+    return (n, shiftX + mx, shiftY + my,
+            sxx / n - np.outer(mx, mx), syy / n - np.outer(my, my), sxy / n - np.outer(mx, my))
+
+
+class StreamingCCA():
+    def __init__(self, n_components=2, reg=1e-4, blockSize=65536):
+        #reg: ridge added to the auto-covariances, relative to their mean variance (keeps them invertible when d > n
+        #or with collinear dimensions)
+        self.n_components = n_components
+        self.reg = reg
+        self.blockSize = blockSize
+
+    def fit(self, X, Y):
+        n, self.meanX, self.meanY, Cxx, Cyy, Cxy = blockMoments(X, Y, self.blockSize)
+        Cxx += self.reg * np.trace(Cxx) / Cxx.shape[0] * np.eye(Cxx.shape[0])
+        Cyy += self.reg * np.trace(Cyy) / Cyy.shape[0] * np.eye(Cyy.shape[0])
+        Lx = cholesky(Cxx, lower=True)
+        Ly = cholesky(Cyy, lower=True)
+        M = solve_triangular(Ly, solve_triangular(Lx, Cxy, lower=True).T, lower=True).T
+        U, S, Vt = np.linalg.svd(M, full_matrices=False)
+        self.x_weights_ = solve_triangular(Lx.T, U, lower=False)
+        self.y_weights_ = solve_triangular(Ly.T, Vt.T, lower=False)
+        self.correlations_ = S
+        #covariance of Y with each canonical variate of X: the best linear prediction of Y from the first k variates
+        #(uncorrelated, unit variance) is meanY + sum_i<k u_i y_loadings_[i]
+        self.y_loadings_ = self.x_weights_.T @ Cxy
+        self.n_samples_ = n
+        return self
+
+    def transform(self, X, Y=None, n_components=None):
+        """Canonical variates of X (and of Y), on the first n_components (default: self.n_components)."""
+        k = self.n_components if n_components is None else n_components
+        x = self.project(X, self.meanX, self.x_weights_[:, :k])
+        if Y is None:
+            return x
+        return x, self.project(Y, self.meanY, self.y_weights_[:, :k])
+
+    def predict(self, X, n_components=None):
+        """Prediction of Y from the first n_components canonical variates of X."""
+        k = self.n_components if n_components is None else n_components
+        return self.meanY + self.transform(X, n_components=k) @ self.y_loadings_[:k]
+
+    def score(self, X, Y, ranks):
+        """R^2 (averaged over the columns of Y, like sklearn's CCA.score) of predict(X, k) for every k of ranks."""
+        kMax = max(ranks)
+        n = X.shape[0]
+        sy = np.zeros(Y.shape[1])
+        syy = np.zeros(Y.shape[1])
+        residuals = np.zeros((len(ranks), Y.shape[1]))
+        for b in range(0, n, self.blockSize):
+            y = np.asarray(Y[b:b + self.blockSize], dtype=np.float64)
+            u = self.project(X[b:b + self.blockSize], self.meanX, self.x_weights_[:, :kMax])
+            sy += np.sum(y, axis=0)
+            syy += np.sum(np.square(y), axis=0)
+            for i, k in enumerate(ranks):
+                residuals[i] += np.sum(np.square(y - self.meanY - u[:, :k] @ self.y_loadings_[:k]), axis=0)
+        total = np.maximum(syy - np.square(sy) / n, 1e-300)
+        return np.mean(1 - residuals / total, axis=1)
+
+    def fit_transform(self, X, Y):
+        return self.fit(X, Y).transform(X, Y)
+
+    def project(self, X, mean, weights):
+        return np.concatenate([(np.asarray(X[b:b + self.blockSize], dtype=np.float64) - mean) @ weights
+                               for b in range(0, X.shape[0], self.blockSize)])
@@ -0,0 +1,101 @@
+"""
+Corpus tokenized once, for word2vec and doc2vec training.
+
+gensim iterates over the corpus once per epoch (plus once to build the vocabulary): re-reading the csv and
+re-tokenizing every document on each pass is wasted work. A TokenCorpus is built in a single pass and stored as
+    <path>.tokens.npy   flat int32 array of the token ids of every document, one after the other,
+    <path>.offsets.npy  int64 offsets: document i is tokens[offsets[i]:offsets[i+1]],
+    <path>.vocab.json   the token of every id,
+    <path>.txt          the same corpus as text, one document per line (tokens separated by a space).
+Iterating over the corpus maps the arrays and streams lists of tokens, with no pandas involved. The .txt file is
+the corpus_file argument of gensim's Word2Vec / Doc2Vec, whose training then scales with the worker threads
+instead of being limited by the python iterator (with corpus_file, the tag of a document is its line number).
+gensim skips the empty lines of a corpus_file without counting them as documents, which would shift the tag of
+every following document: an empty document is written as the single token emptyDocument (that simple_preprocess
+never produces), the binary files keep it empty.
+"""
+import os
+import json
+import numpy as np
+from gensim.utils import simple_preprocess
+from gensim.models.doc2vec import TaggedDocument
+from training import dataCache
+
+corpusVersion = 2  # format of the corpus files, 2: empty documents written as emptyDocument in the .txt
+emptyDocument = "<empty>"
+
+
+class TokenCorpus():
+    """An iterator that yields documents (lists of str) from the binary token files of path."""
+    def __init__(self, path):
+        self.path = path
+        self.corpusFile = path + ".txt"
+        self.tokens = np.load(path + ".tokens.npy", mmap_mode="r")
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+        with open(path + ".vocab.json", encoding="utf-8") as f:
+            self.vocab = json.load(f)
+
+    @classmethod
+    def build(cls, path, texts, tokenize=simple_preprocess):
+        """Tokenize every text once and write the corpus files of path."""
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        vocab = {}
+        tokens = []
+        offsets = [0]
+        with open(path + ".txt", "w", encoding="utf-8") as corpusFile:
+            for text in texts:
+                words = tokenize(text) if isinstance(text, str) else []
+                corpusFile.write((" ".join(words) if words else emptyDocument) + "\n")
+                tokens += [vocab.setdefault(w, len(vocab)) for w in words]
+                offsets += [len(tokens)]
+        np.save(path + ".tokens.npy", np.asarray(tokens, dtype=np.int32))
+        np.save(path + ".offsets.npy", np.asarray(offsets, dtype=np.int64))
+        with open(path + ".vocab.json", "w", encoding="utf-8") as f:
+            json.dump(list(vocab), f)
+        return cls(path)
+
+    @classmethod
+    def cached(cls, path, sourcePath, loadTexts, tokenize=simple_preprocess):
+        """
+        The corpus of path, rebuilt from loadTexts() only if sourcePath changed since it was built
+        (loadTexts is not called when the corpus is up to date).
+        """
+        if not dataCache.isFresh(sourcePath, path + ".tokens.npy", corpusVersion):
+            cls.build(path, loadTexts(), tokenize)
+            dataCache.markFresh(sourcePath, path + ".tokens.npy", corpusVersion)
+        return cls(path)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def totalWords(self):
+        return int(self.offsets[-1])
+
+    def document(self, i):
+        return [self.vocab[t] for t in self.tokens[self.offsets[i]:self.offsets[i + 1]]]
+
+    def __iter__(self, chunkSize=10000):
+        vocab = self.vocab
+        for start in range(0, len(self), chunkSize):
+            end = min(start + chunkSize, len(self))
+            chunk = np.asarray(self.tokens[self.offsets[start]:self.offsets[end]])
+            bounds = np.asarray(self.offsets[start:end + 1]) - self.offsets[start]
+            words = [vocab[t] for t in chunk.tolist()]
+            for i in range(end - start):
+                yield words[bounds[i]:bounds[i + 1]]
+
+
+class TaggedTokenCorpus():
+    """The documents of a TokenCorpus as doc2vec TaggedDocument, tagged by their position."""
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.corpusFile = corpus.corpusFile
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __iter__(self):
+        for i, words in enumerate(self.corpus):
+            yield TaggedDocument(words, [i])
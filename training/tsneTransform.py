@@ -0,0 +1,130 @@
+"""
+t-SNE with an out-of-sample transform.
+
+sklearn's TSNE can only embed the points it is fitted on. TsneTransform fits it once on the reference points, keeps
+their embedding, and places new points by optimizing only their own coordinates against the fixed reference:
+    - the affinities p_ij of a new point i are computed on its 3*perplexity nearest reference points, with the
+      bandwidth calibrated to the perplexity (as in the fit),
+    - each new point starts at the p-weighted mean of the embedding of its neighbors,
+    - the gradient of KL(P_i||Q_i) is 4 * (sum_j p_ij w_ij (y_i - y_j) - sum_j w_ij^2 (y_i - y_j) / sum_j w_ij),
+      with w_ij = 1/(1+|y_i - y_j|^2) over every reference point j.
+The reference being fixed, the two repulsive sums are functions of y_i only: they are computed once, after the fit,
+on a regular grid by FFT convolutions of the (bilinearly splatted) reference density with the kernels, and
+interpolated at y_i on every iteration. A new point never interacts with the other new points, so transform costs
+O(new points) per iteration, a fraction of a fit.
+"""
+import numpy as np
+from scipy.ndimage import map_coordinates
+from sklearn.manifold import TSNE
+from training.exactKnn import ExactKnn
+
+gridSizes = {1: 8192, 2: 512, 3: 64}  # grid of the repulsive fields, per embedding dimension
+
+
+def conditionalAffinities(sqDistances, perplexity, iterations=64):
+    """Row-normalized exp(-beta*d^2) with beta found by bisection so that every row has the given perplexity."""
+    sqDistances = sqDistances - sqDistances[:, :1]  # distances relative to the nearest neighbor, for stability
+    target = np.log(perplexity)
+    lo = np.zeros(sqDistances.shape[0])
+    hi = np.full(sqDistances.shape[0], np.inf)
+    beta = np.ones(sqDistances.shape[0])
+    for _ in range(iterations):
+        p = np.exp(-sqDistances * beta[:, None])
+        sumP = np.sum(p, axis=1)
+        entropy = np.log(sumP) + beta * np.sum(sqDistances * p, axis=1) / sumP
+        tooFlat = entropy > target
+        lo = np.where(tooFlat, beta, lo)
+        hi = np.where(tooFlat, hi, beta)
+        beta = np.where(np.isinf(hi), beta * 2, (lo + hi) / 2)
+    p = np.exp(-sqDistances * beta[:, None])
+    return p / np.sum(p, axis=1, keepdims=True)
+
+
+class TsneTransform():
+    def __init__(self, n_components=2, perplexity=30.0, random_state=0, n_iter=250, learning_rate=1.0):
+        self.n_components = n_components
+        self.perplexity = perplexity
+        self.tsne = TSNE(n_components=n_components, perplexity=perplexity, random_state=random_state)
+        self.n_iter = n_iter
+        self.learning_rate = learning_rate
+
+    def fit_transform(self, data):
+        """Fit the t-SNE on data (the reference points) and return their embedding."""
+        self.reference = ExactKnn(data)
+        self.embedding = self.tsne.fit_transform(np.asarray(data))
+        self.neighbors = min(len(self.reference) - 1, int(3 * self.perplexity))
+        if self.n_components in gridSizes:
+            self.buildGrid(gridSizes[self.n_components])
+        else:
+            self.grid = None
+        return self.embedding
+
+    def fit(self, data):
+        self.fit_transform(data)
+        return self
+
+    def buildGrid(self, gridSize):
+        """Repulsive fields sum_j w(y - y_j) and sum_j w(y - y_j)^2 (y - y_j) at the nodes of a regular grid."""
+        dim = self.n_components
+        span = np.max(self.embedding, axis=0) - np.min(self.embedding, axis=0)
+        self.lo = np.min(self.embedding, axis=0) - 0.1 * span - 1
+        self.step = (1.2 * span + 2) / (gridSize - 1)
+        self.gridSize = gridSize
+        # reference density on the grid nodes, each point splatted on the 2^dim corners of its cell
+        coords = (self.embedding - self.lo) / self.step
+        base = np.minimum(np.floor(coords).astype(np.int64), gridSize - 2)
+        frac = coords - base
+        density = np.zeros(gridSize ** dim)
+        for corner in np.ndindex(*([2] * dim)):
+            corner = np.array(corner)
+            weight = np.prod(np.where(corner == 1, frac, 1 - frac), axis=1)
+            density += np.bincount(np.ravel_multi_index((base + corner).T, (gridSize,) * dim), weight,
+                                   minlength=gridSize ** dim)
+        density = density.reshape((gridSize,) * dim)
+        # kernels on the offsets -(gridSize-1)..gridSize-1 of every axis, then linear convolutions with zero-padded FFTs
+        axes = np.meshgrid(*[np.arange(-(gridSize - 1), gridSize) * self.step[a] for a in range(dim)], indexing="ij")
+        w = 1 / (1 + sum(np.square(a) for a in axes))
+        shape = (2 * gridSize - 1,) * dim
+        densityFft = np.fft.rfftn(density, shape)
+        window = tuple(slice(gridSize - 1, 2 * gridSize - 1) for _ in range(dim))
+        fields = [np.fft.irfftn(densityFft * np.fft.rfftn(kernel, shape), shape)[window]
+                  for kernel in [w] + [np.square(w) * a for a in axes]]
+        self.grid = np.stack(fields)  # (1+dim, gridSize, ..., gridSize)
+
+    def repulsion(self, Y):
+        """(Z, R): sum_j w(y - y_j) and sum_j w(y - y_j)^2 (y - y_j) for every row y of Y."""
+        if self.grid is not None:
+            coords = (Y - self.lo) / self.step
+            inside = np.all((coords >= 0) & (coords <= self.gridSize - 1), axis=1)
+        else:
+            inside = np.zeros(Y.shape[0], dtype=bool)
+        Z = np.empty(Y.shape[0])
+        R = np.empty(Y.shape)
+        if inside.any():
+            values = np.stack([map_coordinates(field, coords[inside].T, order=1) for field in self.grid])
+            Z[inside], R[inside] = values[0], values[1:].T
+        for b in np.nonzero(~inside)[0]:
+            diff = Y[b] - self.embedding
+            w = 1 / (1 + np.sum(np.square(diff), axis=1))
+            Z[b], R[b] = np.sum(w), np.sum(np.square(w)[:, None] * diff, axis=0)
+        return Z, R
+
+    def transform(self, data):
+        """Embed new points against the fixed embedding of the reference points."""
+        distances, ids = self.reference.query(data, self.neighbors)
+        ids = np.reshape(ids, (-1, self.neighbors))
+        P = conditionalAffinities(np.square(np.reshape(distances, ids.shape).astype(np.float64)), self.perplexity)
+        neighborsY = self.embedding[ids]
+        Y = np.sum(P[:, :, None] * neighborsY, axis=1)
+        update = np.zeros_like(Y)
+        gains = np.ones_like(Y)
+        for it in range(self.n_iter):
+            diff = Y[:, None, :] - neighborsY
+            w = 1 / (1 + np.sum(np.square(diff), axis=2))
+            Z, R = self.repulsion(Y)
+            gradient = 4 * (np.sum((P * w)[:, :, None] * diff, axis=1) - R / Z[:, None])
+            gains = np.where(np.sign(gradient) != np.sign(update), gains + 0.2, gains * 0.8).clip(0.01)
+            momentum = 0.5 if it < 100 else 0.8
+            update = momentum * update - self.learning_rate * gains * gradient
+            Y = Y + update
+        return Y
@@ -22,6 +22,7 @@ import random
 import numpy as np
 
 import pandas as pd
+from training import dataCache
 
 
 # reparameterization trick
@@ -240,8 +241,7 @@ def vaeGenerator(dataset, original_dim_inputs, intermediate_dim, latent_dim, bat
     return output_gen
 
 
-dataset=pd.read_csv("data3/target_context.csv")
-dataset.drop(dataset.columns[[0]], axis=1, inplace=True)
+dataset=pd.DataFrame(dataCache.readEmbedding(os.path.join("data3","target_context.emb")))
 print(dataset)
 print(dataset.shape)
 
@@ -8,23 +8,20 @@ A more powerful idea is to use doc2vec strategy... or bert!
 """
 
 import gensim
-import pandas as pd
 import os
+from training import dataCache
+from training.tokenCorpus import TokenCorpus
 
 restrictSize = 10000
 
-class MyCorpus(object):
-    """An interator that yields sentences (lists of str)."""
-    def __iter__(self):
-        data = pd.read_csv(os.path.join("data3","exact_hits.csv"),sep="\t",nrows=restrictSize)
-        target_context_data = data.values[:restrictSize,2]
-        for line in target_context_data:
-            # assume there's one document per line, tokens separated by whitespace
-            yield gensim.utils.simple_preprocess(line)
-
-sentences = MyCorpus()
+# The target contexts are tokenized once (simple_preprocess) into a binary token corpus (see tokenCorpus.py),
+# rebuilt only when exact_hits.csv changes. Iterating over it yields sentences (lists of str) without pandas.
+hits_path = os.path.join("data3","exact_hits.csv")
+sentences = TokenCorpus.cached(os.path.join("data3","cache","target_context_"+str(restrictSize)),hits_path,
+                               lambda: dataCache.readHits(hits_path,nrows=restrictSize).values[:,2])
 print("corpus ready")
-model = gensim.models.Word2Vec(sentences=sentences,workers = 4 )
+# corpus_file: gensim reads the text version of the corpus in its worker threads, without the python iterator
+model = gensim.models.Word2Vec(corpus_file=sentences.corpusFile,workers = 4 )
 print("finished training")
 
 from sklearn.manifold import TSNE                   # final reduction